@@ -5,24 +5,80 @@ import asyncio
 import threading
 import discord
 import aiohttp
-import requests
 from discord.ext import commands
-from flask import Flask, request
+from aiohttp import web
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 import time
-from PIL import Image, ImageDraw
+import atexit
+import signal
+import functools
+import logging
+import logging.handlers
+import queue
+import sys
+import weakref
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 import io
+import re
+import string
+import gzip
+import html
+import hashlib
+import importlib
+import importlib.util
 import aiohttp
 
-# Try to import psycopg2, fallback to JSONBin if not available
+# psycopg2 và PIL chỉ được import khi dùng lần đầu để giảm bộ nhớ lúc khởi động
+HAS_PSYCOPG2 = importlib.util.find_spec("psycopg2") is not None
+if HAS_PSYCOPG2:
+    print("✅ psycopg2 available")
+else:
+    print("⚠️ WARNING: psycopg2 not available, using JSONBin.io storage only")
+
+@functools.cache
+def _get_psycopg2():
+    """Import psycopg2 (kèm psycopg2.pool, psycopg2.extras) khi cần, trả về None nếu lỗi"""
+    try:
+        import psycopg2
+        import psycopg2.extras
+        import psycopg2.pool
+        return psycopg2
+    except ImportError as e:
+        print(f"⚠️ psycopg2 import error: {e}")
+        return None
+
+@functools.cache
+def _get_pil():
+    """Import PIL.Image khi cần (chỉ roster dùng đến)"""
+    return importlib.import_module("PIL.Image")
+
+# Try to import orjson for faster (de)serialization, fallback to stdlib json
 try:
-    import psycopg2
-    HAS_PSYCOPG2 = True
-    print("✅ psycopg2 imported successfully")
+    import orjson
+    HAS_ORJSON = True
 except ImportError:
-    HAS_PSYCOPG2 = False
-    print("⚠️ WARNING: psycopg2 not available, using JSONBin.io storage only")
+    HAS_ORJSON = False
+
+# uvloop (tùy chọn, không có trên Windows): event loop nhanh hơn cho cả bot lẫn web server
+try:
+    import uvloop
+    HAS_UVLOOP = True
+except ImportError:
+    HAS_UVLOOP = False
+
+def json_dumps(obj) -> bytes:
+    """Serialize JSON dạng gọn (bytes), ưu tiên orjson"""
+    if HAS_ORJSON:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+def json_loads(data):
+    """Parse JSON từ bytes/str, ưu tiên orjson"""
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
 
 # --- LOAD ENVIRONMENT VARIABLES ---
 load_dotenv()
@@ -50,132 +106,328 @@ if not JSONBIN_API_KEY or not JSONBIN_BIN_ID:
 PORT = int(os.getenv('PORT', 5000))
 RENDER_URL = os.getenv('RENDER_EXTERNAL_URL', f'http://127.0.0.1:{PORT}')
 REDIRECT_URI = f'{RENDER_URL}/callback'
+# Link OAuth2 chỉ phụ thuộc CLIENT_ID/REDIRECT_URI -> dựng một lần cho lệnh !auth và trang chủ
+AUTH_URL = (
+    f'https://discord.com/api/oauth2/authorize?client_id={CLIENT_ID}'
+    f'&redirect_uri={REDIRECT_URI}&response_type=code&scope=identify%20guilds.join'
+)
+
+# --- LOGGING ---
+# Logger cho các vòng lặp chạy song song: QueueHandler chỉ đẩy vào hàng đợi,
+# thread của QueueListener mới thực sự ghi ra stdout nên không chặn event loop
+logger = logging.getLogger("interlink")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# --- SHARED HTTP SESSION ---
+# Một aiohttp session dùng chung cho toàn bộ bot, tạo trong setup_hook và đóng khi bot tắt
+http_session = None
+
+async def get_http_session():
+    """Lấy (hoặc tạo) aiohttp session dùng chung"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=50,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True
+        )
+        http_session = aiohttp.ClientSession(connector=connector)
+        print("✅ Shared HTTP session ready")
+    return http_session
+
+async def close_http_session():
+    """Đóng aiohttp session dùng chung"""
+    global http_session
+    if http_session and not http_session.closed:
+        await http_session.close()
+    http_session = None
 
 # --- JSONBIN.IO FUNCTIONS ---
+def normalize_token_entries(data):
+    """Chuyển các bản ghi kiểu cũ (token là chuỗi trần) sang dạng dict chuẩn, sửa tại chỗ.
+    Khóa bắt đầu bằng '_' (vd. _roster_order) là metadata nên bỏ qua. Trả về số bản ghi đã sửa"""
+    fixed = 0
+    for key, value in data.items():
+        if not key.startswith('_') and not isinstance(value, dict):
+            data[key] = {'access_token': value, 'username': None, 'avatar_hash': None}
+            fixed += 1
+    return fixed
+
 class JSONBinStorage:
     def __init__(self):
         self.api_key = JSONBIN_API_KEY
         self.bin_id = JSONBIN_BIN_ID
         self.base_url = "https://api.jsonbin.io/v3"
+        self._headers = None
+        # Cache trong bộ nhớ: chỉ tải lại toàn bộ bin sau mỗi _ttl giây
+        self._cache = None
+        self._cache_ts = 0
+        self._ttl = 30
+        # Single-flight: nhiều lệnh cùng lúc chỉ kích hoạt một lần tải bin
+        self._load_lock = asyncio.Lock()
+        # Ghi trễ (write-back): gom các thay đổi trong _flush_delay giây thành một lần PUT
+        self._dirty = False
+        self._flush_delay = 1
+        self._flush_task = None
+        # JSONBin chỉ có PUT cả bin -> tuần tự hóa các lần ghi để bản cũ không ghi đè bản mới
+        self._write_lock = asyncio.Lock()
+        # Kết quả request đọc/ghi gần nhất (None = chưa gọi lần nào), /health đọc cờ này thay vì gọi mạng
+        self.last_ok = None
         
     def _get_headers(self):
-        """Tạo headers cho requests"""
-        return {
-            "Content-Type": "application/json",
-            "X-Master-Key": self.api_key,
-            "X-Access-Key": self.api_key
-        }
-    
-    def create_bin(self, data=None):
+        """Headers cho mọi request tới JSONBin (dựng một lần rồi dùng lại)"""
+        if self._headers is None:
+            self._headers = {
+                "Content-Type": "application/json",
+                "X-Master-Key": self.api_key,
+                "X-Access-Key": self.api_key
+            }
+        return self._headers
+    
+    async def create_bin(self, data=None):
         """Tạo bin mới nếu chưa có"""
         if data is None:
             data = {}
         
         try:
-            response = requests.post(
+            session = await get_http_session()
+            async with session.post(
                 f"{self.base_url}/b",
-                json=data,
+                data=json_dumps(data),
                 headers=self._get_headers()
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                self.bin_id = result['metadata']['id']
-                print(f"✅ Created new JSONBin: {self.bin_id}")
-                print(f"🔑 Add this to your .env: JSONBIN_BIN_ID={self.bin_id}")
-                return self.bin_id
-            else:
-                print(f"❌ Failed to create bin: {response.text}")
-                return None
+            ) as response:
+                if response.status == 200:
+                    result = json_loads(await response.read())
+                    self.bin_id = result['metadata']['id']
+                    print(f"✅ Created new JSONBin: {self.bin_id}")
+                    print(f"🔑 Add this to your .env: JSONBIN_BIN_ID={self.bin_id}")
+                    return self.bin_id
+                else:
+                    print(f"❌ Failed to create bin: {await response.text()}")
+                    return None
         except Exception as e:
             print(f"❌ JSONBin create error: {e}")
             return None
     
-    def read_data(self):
-        """Đọc dữ liệu từ JSONBin"""
+    def _set_cache(self, data):
+        """Cập nhật cache và thời điểm tải"""
+        self._cache = data
+        self._cache_ts = time.monotonic()
+
+    def _cache_fresh(self):
+        # Không tải lại khi còn thay đổi chưa ghi, tránh mất dữ liệu cục bộ
+        return self._cache is not None and (self._dirty or time.monotonic() - self._cache_ts < self._ttl)
+
+    def invalidate(self):
+        """Buộc lần đọc sau tải lại bin (bỏ qua nếu còn thay đổi chưa ghi)"""
+        if not self._dirty:
+            self._cache_ts = 0
+
+    async def _get_cache(self):
+        """Trả về dict cache (tải lại từ JSONBin nếu hết hạn), None nếu đọc lỗi"""
+        if self._cache_fresh():
+            return self._cache
+
+        async with self._load_lock:
+            # Request khác có thể đã tải xong trong lúc chờ lock
+            if self._cache_fresh():
+                return self._cache
+            return await self._load()
+
+    async def _load(self):
+        """Tải toàn bộ bin từ JSONBin vào cache"""
         if not self.bin_id:
             print("⚠️ No bin ID, creating new bin...")
-            self.create_bin()
-            return {}
+            await self.create_bin()
+            self._set_cache({})
+            return self._cache
             
         try:
-            response = requests.get(
+            session = await get_http_session()
+            async with session.get(
                 f"{self.base_url}/b/{self.bin_id}/latest",
                 headers=self._get_headers()
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                return data.get('record', {})
-            elif response.status_code == 404:
-                print("⚠️ Bin not found, creating new one...")
-                self.create_bin()
-                return {}
-            else:
-                print(f"❌ Failed to read from JSONBin: {response.status_code}")
-                return {}
+            ) as response:
+                if response.status == 200:
+                    self.last_ok = True
+                    data = json_loads(await response.read())
+                    self._set_cache(data.get('record', {}))
+                    # Chuẩn hóa một lần khi tải để các lệnh không phải kiểm tra kiểu từng bản ghi
+                    fixed = normalize_token_entries(self._cache)
+                    if fixed:
+                        print(f"🔧 Normalized {fixed} legacy JSONBin entries")
+                        self._schedule_flush()
+                    return self._cache
+                elif response.status == 404:
+                    self.last_ok = True
+                    print("⚠️ Bin not found, creating new one...")
+                    await self.create_bin()
+                    self._set_cache({})
+                    return self._cache
+                else:
+                    self.last_ok = False
+                    print(f"❌ Failed to read from JSONBin: {response.status}")
+                    return None
         except Exception as e:
+            self.last_ok = False
             print(f"❌ JSONBin read error: {e}")
-            return {}
+            return None
+
+    async def read_data(self):
+        """Đọc dữ liệu từ JSONBin (qua cache, trả về bản sao)"""
+        data = await self._get_cache()
+        return dict(data) if data is not None else {}
     
-    def write_data(self, data):
+    async def write_data(self, data):
         """Ghi dữ liệu vào JSONBin"""
         if not self.bin_id:
             print("⚠️ No bin ID, creating new bin...")
-            if not self.create_bin(data):
+            if not await self.create_bin(data):
                 return False
         
         try:
-            response = requests.put(
-                f"{self.base_url}/b/{self.bin_id}",
-                json=data,
-                headers=self._get_headers()
-            )
-            
-            if response.status_code == 200:
-                print("✅ Data saved to JSONBin successfully")
-                return True
-            else:
-                print(f"❌ Failed to save to JSONBin: {response.status_code} - {response.text}")
-                return False
+            async with self._write_lock:
+                session = await get_http_session()
+                async with session.put(
+                    f"{self.base_url}/b/{self.bin_id}",
+                    data=json_dumps(data),
+                    headers=self._get_headers()
+                ) as response:
+                    if response.status == 200:
+                        self.last_ok = True
+                        print("✅ Data saved to JSONBin successfully")
+                        self._set_cache(data)
+                        return True
+                    else:
+                        self.last_ok = False
+                        print(f"❌ Failed to save to JSONBin: {response.status} - {await response.text()}")
+                        return False
         except Exception as e:
+            self.last_ok = False
             print(f"❌ JSONBin write error: {e}")
             return False
     
-    def get_user_token(self, user_id):
+    def _schedule_flush(self):
+        """Đánh dấu cache đã thay đổi và lên lịch ghi trễ lên JSONBin"""
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        """Chờ _flush_delay giây rồi ghi, lặp lại nếu có thay đổi mới trong lúc ghi"""
+        while self._dirty:
+            await asyncio.sleep(self._flush_delay)
+            if not await self.flush():
+                break
+
+    async def flush(self):
+        """Ghi ngay các thay đổi đang chờ lên JSONBin"""
+        if not self._dirty or self._cache is None:
+            return True
+        self._dirty = False
+        if not await self.write_data(self._cache):
+            self._dirty = True
+            return False
+        return True
+
+    async def get_user_token(self, user_id):
         """Lấy token của user từ JSONBin"""
-        data = self.read_data()
-        user_data = data.get(str(user_id))
-        
-        if isinstance(user_data, dict):
-            return user_data.get('access_token')
-        return user_data
+        data = await self._get_cache() or {}
+        return data.get(str(user_id), {}).get('access_token')
     
-    def save_user_token(self, user_id, access_token, username=None, avatar_hash=None):
-        """Lưu token của user vào JSONBin"""
-        data = self.read_data()
+    async def save_user_token(self, user_id, access_token, username=None, avatar_hash=None):
+        """Lưu token của user vào JSONBin (cập nhật cache, ghi trễ)"""
+        data = await self._get_cache()
+        if data is None:
+            print(f"❌ JSONBin unavailable, cannot save token for user {user_id}")
+            return False
         
         data[str(user_id)] = {
             'access_token': access_token,
             'username': username,
             'avatar_hash': avatar_hash,
-            'updated_at': str(time.time())
+            'updated_at': int(time.time())
         }
         
-        return self.write_data(data)
+        self._schedule_flush()
+        return True
 
-    def delete_user(self, user_id):
-        """Xóa một user khỏi JSONBin"""
-        data = self.read_data()
+    async def save_user_tokens_bulk(self, items):
+        """Lưu nhiều token cùng lúc: cập nhật cache rồi ghi một lần PUT duy nhất
+        items: list (user_id, access_token, username, avatar_hash). Trả về số token đã lưu"""
+        data = await self._get_cache()
+        if data is None:
+            print("❌ JSONBin unavailable, cannot save tokens")
+            return 0
+
+        now = int(time.time())
+        for user_id, access_token, username, avatar_hash in items:
+            data[str(user_id)] = {
+                'access_token': access_token,
+                'username': username,
+                'avatar_hash': avatar_hash,
+                'updated_at': now
+            }
+
+        self._dirty = True
+        if not await self.flush():
+            return 0
+        # Như save_user_token: cập nhật AGENT_INDEX ngay để roster/deploy thấy các điệp viên mới
+        for user_id, _, username, avatar_hash in items:
+            index_agent(user_id, username, avatar_hash)
+        return len(items)
+
+    async def save_roster_order(self, roster_order):
+        """Lưu thứ tự roster vào cache rồi ghi ngay (không ghi đè token vừa được lưu song song)"""
+        data = await self._get_cache()
+        if data is None:
+            return False
+        data['_roster_order'] = roster_order
+        self._dirty = True
+        return await self.flush()
+
+    async def delete_user(self, user_id):
+        """Xóa một user khỏi JSONBin (cập nhật cache, ghi trễ)"""
+        data = await self._get_cache()
+        if data is None:
+            return False
         if str(user_id) in data:
             del data[str(user_id)]
-            return self.write_data(data)
+            self._schedule_flush()
         return True # Trả về True nếu user không tồn tại sẵn
 
 # Khởi tạo JSONBin storage
 jsonbin_storage = JSONBinStorage()
 
 # --- DATABASE SETUP ---
+# Pool kết nối dùng chung, tạo một lần khi khởi động thay vì connect mỗi lần truy vấn
+db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Lấy (hoặc tạo) connection pool tới database"""
+    global db_pool
+    if db_pool is None and DATABASE_URL and HAS_PSYCOPG2:
+        with _db_pool_lock:
+            if db_pool is None:
+                try:
+                    psycopg2 = _get_psycopg2()
+                    if psycopg2 is None:
+                        return None
+                    db_pool = psycopg2.pool.ThreadedConnectionPool(1, 10, DATABASE_URL, sslmode='require')
+                    atexit.register(db_pool.closeall)
+                except Exception as e:
+                    print(f"Database pool error: {e}")
+    return db_pool
+
 def init_database():
     """Khởi tạo database và tạo bảng nếu chưa có"""
     if not DATABASE_URL or not HAS_PSYCOPG2:
@@ -183,23 +435,24 @@ def init_database():
         return False
     
     try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        cursor = conn.cursor()
-        
-        # Tạo bảng user_tokens nếu chưa có
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_tokens (
-                user_id VARCHAR(50) PRIMARY KEY,
-                access_token TEXT NOT NULL,
-                username VARCHAR(100),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with db_connection() as conn:
+            if not conn:
+                raise RuntimeError("connection pool unavailable")
+            cursor = conn.cursor()
+            
+            # Tạo bảng user_tokens nếu chưa có
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_tokens (
+                    user_id VARCHAR(50) PRIMARY KEY,
+                    access_token TEXT NOT NULL,
+                    username VARCHAR(100),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            conn.commit()
+            cursor.close()
         print("✅ Database initialized successfully")
         return True
         
@@ -210,179 +463,638 @@ def init_database():
 
 # --- DATABASE FUNCTIONS ---
 def get_db_connection():
-    """Tạo connection tới database"""
-    if DATABASE_URL and HAS_PSYCOPG2:
+    """Lấy connection từ pool (nhớ trả lại bằng release_db_connection)"""
+    pool = get_db_pool()
+    if pool:
         try:
-            return psycopg2.connect(DATABASE_URL, sslmode='require')
+            return pool.getconn()
         except Exception as e:
             print(f"Database connection error: {e}")
             return None
     return None
 
-def get_user_access_token_db(user_id: str):
-    """Lấy access token từ database"""
-    conn = get_db_connection()
-    if conn:
+def release_db_connection(conn):
+    """Trả connection về pool"""
+    pool = get_db_pool()
+    if pool and conn:
         try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT access_token FROM user_tokens WHERE user_id = %s", (user_id,))
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            return result[0] if result else None
+            pool.putconn(conn)
         except Exception as e:
-            print(f"Database error: {e}")
-            if conn:
-                conn.close()
-    return None
+            print(f"Database release error: {e}")
 
-def save_user_token_db(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
-    """Lưu access token vào database"""
+@contextmanager
+def db_connection():
+    """Context manager: lấy connection từ pool và luôn trả lại khi xong (None nếu không có DB)"""
     conn = get_db_connection()
-    if conn:
+    try:
+        yield conn
+    finally:
+        release_db_connection(conn)
+
+def is_db_available():
+    """Kiểm tra nhanh database có sẵn sàng không"""
+    with db_connection() as conn:
+        return conn is not None
+
+# Trạng thái DB do db_health_loop cập nhật định kỳ, các trang web/lệnh chỉ đọc cờ này
+DB_HEALTH = False
+_DB_HEALTH_INTERVAL = 30
+_db_health_task = None
+
+def probe_db():
+    """Chạy SELECT 1 qua pool để kiểm tra database còn sống"""
+    with db_connection() as conn:
+        if not conn:
+            return False
         try:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO user_tokens (user_id, access_token, username, avatar_hash) 
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (user_id) 
-                DO UPDATE SET 
-                    access_token = EXCLUDED.access_token,
-                    username = EXCLUDED.username,
-                    avatar_hash = EXCLUDED.avatar_hash,
-                    updated_at = CURRENT_TIMESTAMP
-            ''', (user_id, access_token, username, avatar_hash))
-            conn.commit()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
             cursor.close()
-            conn.close()
-            print(f"✅ Saved token for user {user_id} to database")
             return True
         except Exception as e:
-            print(f"Database error: {e}")
-            if conn:
-                conn.close()
+            print(f"Database health check error: {e}")
+            return False
+
+async def refresh_db_health():
+    global DB_HEALTH
+    DB_HEALTH = await asyncio.to_thread(probe_db)
+    return DB_HEALTH
+
+async def db_health_loop():
+    """Kiểm tra database mỗi _DB_HEALTH_INTERVAL giây (chạy nền), kèm làm mới ảnh chụp /health"""
+    while True:
+        await asyncio.sleep(_DB_HEALTH_INTERVAL)
+        await refresh_db_health()
+        try:
+            await refresh_health_snapshot()
+        except Exception as e:
+            print(f"⚠️ Health snapshot refresh error: {e}")
+
+def start_db_health_check():
+    global _db_health_task
+    if _db_health_task is None or _db_health_task.done():
+        _db_health_task = asyncio.create_task(db_health_loop())
+
+def stop_db_health_check():
+    global _db_health_task
+    if _db_health_task is not None:
+        _db_health_task.cancel()
+        _db_health_task = None
+
+def get_user_access_token_db(user_id: str):
+    """Lấy access token từ database"""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT access_token FROM user_tokens WHERE user_id = %s", (user_id,))
+                result = cursor.fetchone()
+                cursor.close()
+                return result[0] if result else None
+            except Exception as e:
+                print(f"Database error: {e}")
+    return None
+
+def get_user_access_tokens_db(user_ids: list[str]):
+    """Lấy access token của nhiều user từ database bằng một truy vấn"""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT user_id, access_token FROM user_tokens WHERE user_id = ANY(%s)",
+                    (list(user_ids),)
+                )
+                rows = cursor.fetchall()
+                cursor.close()
+                return {row[0]: row[1] for row in rows}
+            except Exception as e:
+                print(f"Database error: {e}")
+    return {}
+
+# Câu upsert token được PREPARE một lần trên mỗi connection của pool
+_SAVE_TOKEN_PREPARE = '''
+    PREPARE save_token(varchar, text, varchar, varchar) AS
+    INSERT INTO user_tokens (user_id, access_token, username, avatar_hash) 
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (user_id) 
+    DO UPDATE SET 
+        access_token = EXCLUDED.access_token,
+        username = EXCLUDED.username,
+        avatar_hash = EXCLUDED.avatar_hash,
+        updated_at = CURRENT_TIMESTAMP
+'''
+_prepared_conns = weakref.WeakSet()
+
+def _ensure_save_token_prepared(conn, cursor):
+    """PREPARE câu upsert nếu connection này chưa có"""
+    if conn not in _prepared_conns:
+        cursor.execute(_SAVE_TOKEN_PREPARE)
+        _prepared_conns.add(conn)
+
+def save_user_token_db(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
+    """Lưu access token vào database"""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                _ensure_save_token_prepared(conn, cursor)
+                cursor.execute(
+                    "EXECUTE save_token(%s, %s, %s, %s)",
+                    (user_id, access_token, username, avatar_hash)
+                )
+                conn.commit()
+                cursor.close()
+                print(f"✅ Saved token for user {user_id} to database")
+                return True
+            except Exception as e:
+                print(f"Database error: {e}")
     return False
 
+def load_all_tokens_db():
+    """Đọc toàn bộ bảng user_tokens bằng server-side cursor (stream theo lô, không fetchall)"""
+    source_data = {}
+    with db_connection() as conn:
+        if conn:
+            cursor = conn.cursor(name='migrate_tokens_src')
+            cursor.itersize = 2000
+            try:
+                cursor.execute("SELECT user_id, access_token, username FROM user_tokens")
+                now = int(time.time())
+                source_data = {
+                    row[0]: {'access_token': row[1], 'username': row[2], 'updated_at': now}
+                    for row in cursor
+                }
+            finally:
+                cursor.close()
+                conn.rollback()
+    return source_data
+
+def save_user_tokens_bulk_db(items):
+    """Lưu nhiều token vào database bằng một câu INSERT (execute_values)
+    items: list (user_id, access_token, username, avatar_hash). Trả về số token đã lưu"""
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                _get_psycopg2().extras.execute_values(cursor, '''
+                    INSERT INTO user_tokens (user_id, access_token, username, avatar_hash)
+                    VALUES %s
+                    ON CONFLICT (user_id)
+                    DO UPDATE SET
+                        access_token = EXCLUDED.access_token,
+                        username = EXCLUDED.username,
+                        avatar_hash = EXCLUDED.avatar_hash,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', items)
+                conn.commit()
+                cursor.close()
+                print(f"✅ Saved {len(items)} tokens to database")
+                return len(items)
+            except Exception as e:
+                print(f"Database error: {e}")
+    return 0
+
 # --- FALLBACK JSON FUNCTIONS (kept for compatibility) ---
+TOKENS_FILE = 'tokens.json'
+# Bản sao tokens.json trong bộ nhớ: nạp một lần, ghi xuống đĩa theo lô (tối đa mỗi 2 giây)
+_TOKENS_CACHE = None
+_tokens_dirty = False
+_tokens_flush_task = None
+_TOKENS_FLUSH_DELAY = 2
+
+def _load_tokens_json():
+    """Nạp tokens.json vào bộ nhớ (chỉ đọc file ở lần gọi đầu tiên)"""
+    global _TOKENS_CACHE
+    if _TOKENS_CACHE is None:
+        try:
+            with open(TOKENS_FILE, 'rb') as f:
+                _TOKENS_CACHE = json_loads(f.read())
+        except (FileNotFoundError, json.JSONDecodeError):
+            _TOKENS_CACHE = {}
+        fixed = normalize_token_entries(_TOKENS_CACHE)
+        if fixed:
+            print(f"🔧 Normalized {fixed} legacy tokens.json entries")
+            _schedule_tokens_flush()
+    return _TOKENS_CACHE
+
+def _write_tokens_file(tokens):
+    """Ghi tokens xuống file (chạy trong thread riêng)"""
+    with open(TOKENS_FILE, 'wb') as f:
+        f.write(json_dumps(tokens))
+
+def _schedule_tokens_flush():
+    """Đánh dấu có thay đổi và lên lịch ghi tokens.json"""
+    global _tokens_dirty, _tokens_flush_task
+    _tokens_dirty = True
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # Không có event loop đang chạy: ghi ngay
+        _tokens_dirty = False
+        _write_tokens_file(dict(_TOKENS_CACHE))
+        return
+    if _tokens_flush_task is None or _tokens_flush_task.done():
+        _tokens_flush_task = asyncio.create_task(_flush_tokens_later())
+
+async def _flush_tokens_later():
+    """Chờ rồi ghi, lặp lại nếu có thay đổi mới trong lúc ghi"""
+    while _tokens_dirty:
+        await asyncio.sleep(_TOKENS_FLUSH_DELAY)
+        if not await flush_tokens_json():
+            break
+
+async def flush_tokens_json():
+    """Ghi ngay các thay đổi đang chờ xuống tokens.json"""
+    global _tokens_dirty
+    if not _tokens_dirty:
+        return True
+    _tokens_dirty = False
+    try:
+        # Chụp bản sao nông để thread ghi không đọc dict đang bị sửa
+        await asyncio.to_thread(_write_tokens_file, dict(_TOKENS_CACHE))
+        return True
+    except Exception as e:
+        _tokens_dirty = True
+        print(f"JSON file error: {e}")
+        return False
+
 def get_user_access_token_json(user_id: str):
     """Backup: Lấy token từ file JSON"""
-    try:
-        with open('tokens.json', 'r') as f:
-            tokens = json.load(f)
-            data = tokens.get(str(user_id))
-            if isinstance(data, dict):
-                return data.get('access_token')
-            return data
-    except (FileNotFoundError, json.JSONDecodeError):
-        return None
+    return _load_tokens_json().get(str(user_id), {}).get('access_token')
 
 def save_user_token_json(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
     """Backup: Lưu token vào file JSON"""
     try:
-        try:
-            with open('tokens.json', 'r') as f:
-                tokens = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            tokens = {}
-        
+        tokens = _load_tokens_json()
         tokens[user_id] = {
             'access_token': access_token,
             'username': username,
             'avatar_hash': avatar_hash,
-            'updated_at': str(time.time())
+            'updated_at': int(time.time())
         }
-        
-        with open('tokens.json', 'w') as f:
-            json.dump(tokens, f, indent=4)
+        _schedule_tokens_flush()
         print(f"✅ Saved token for user {user_id} to JSON file")
         return True
     except Exception as e:
         print(f"JSON file error: {e}")
         return False
 
+def save_user_tokens_bulk_json(items):
+    """Backup: Lưu nhiều token vào file JSON với một lần ghi
+    items: list (user_id, access_token, username, avatar_hash). Trả về số token đã lưu"""
+    try:
+        tokens = _load_tokens_json()
+        now = int(time.time())
+        for user_id, access_token, username, avatar_hash in items:
+            tokens[str(user_id)] = {
+                'access_token': access_token,
+                'username': username,
+                'avatar_hash': avatar_hash,
+                'updated_at': now
+            }
+        _schedule_tokens_flush()
+        print(f"✅ Saved {len(items)} tokens to JSON file")
+        return len(items)
+    except Exception as e:
+        print(f"JSON file error: {e}")
+        return 0
+
 # --- UNIFIED TOKEN FUNCTIONS ---
-def get_user_access_token(user_id: int):
-    """Lấy access token (Ưu tiên: Database > JSONBin.io > JSON file)"""
+# Cache token trong bộ nhớ (user_id -> (token, thời điểm lưu)), chỉ lưu kết quả tìm thấy
+_TOKEN_CACHE = {}
+_TOKEN_CACHE_TTL = 300
+
+def _get_cached_token(user_id_str: str):
+    entry = _TOKEN_CACHE.get(user_id_str)
+    if entry and time.monotonic() - entry[1] < _TOKEN_CACHE_TTL:
+        return entry[0]
+    return None
+
+def _cache_token(user_id_str: str, token: str):
+    _TOKEN_CACHE[user_id_str] = (token, time.monotonic())
+
+def invalidate_token_cache(user_id: str):
+    """Xóa token của user khỏi cache (dùng khi xóa user)"""
+    _TOKEN_CACHE.pop(str(user_id), None)
+
+async def get_user_access_token(user_id: int):
+    """Lấy access token (Ưu tiên: Cache > Database > JSONBin.io > JSON file)"""
     user_id_str = str(user_id)
-    
-    # Try database first
-    token = get_user_access_token_db(user_id_str)
+
+    token = _get_cached_token(user_id_str)
     if token:
         return token
     
+    # Try database first
+    token = await asyncio.to_thread(get_user_access_token_db, user_id_str)
+    
     # Try JSONBin.io
-    if JSONBIN_API_KEY:
-        token = jsonbin_storage.get_user_token(user_id_str)
-        if token:
-            return token
+    if not token and JSONBIN_API_KEY:
+        token = await jsonbin_storage.get_user_token(user_id_str)
     
     # Fallback to JSON file (for local development)
-    return get_user_access_token_json(user_id_str)
+    if not token:
+        token = get_user_access_token_json(user_id_str)
 
-def save_user_token(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
-    """Lưu access token (Database + JSONBin.io + JSON backup)"""
-    success_db = save_user_token_db(user_id, access_token, username, avatar_hash)
-    success_jsonbin = False
-    success_json = False
-    
-    # Try JSONBin.io
-    if JSONBIN_API_KEY:
-        success_jsonbin = jsonbin_storage.save_user_token(user_id, access_token, username, avatar_hash)
-    
-    # Local JSON backup (for development)
+    if token:
+        _cache_token(user_id_str, token)
+    return token
+
+async def get_user_access_tokens(user_ids):
+    """Lấy access token cho nhiều user cùng lúc (một truy vấn DB, một lần đọc JSONBin)
+    Trả về dict {user_id (str): token}, user không có token sẽ không có trong dict"""
+    tokens = {}
+    wanted = []
+    for uid in user_ids:
+        uid = str(uid)
+        token = _get_cached_token(uid)
+        if token:
+            tokens[uid] = token
+        else:
+            wanted.append(uid)
+    if not wanted:
+        return tokens
+
+    tokens.update(await asyncio.to_thread(get_user_access_tokens_db, wanted))
+
+    # JSONBin chỉ tải bin một lần nhờ cache, các lần get sau đọc từ bộ nhớ
+    missing = [uid for uid in wanted if uid not in tokens]
+    if missing and JSONBIN_API_KEY:
+        for uid in missing:
+            token = await jsonbin_storage.get_user_token(uid)
+            if token:
+                tokens[uid] = token
+
+    for uid in wanted:
+        if uid not in tokens:
+            token = get_user_access_token_json(uid)
+            if token:
+                tokens[uid] = token
+
+    for uid in wanted:
+        if uid in tokens:
+            _cache_token(uid, tokens[uid])
+    return tokens
+
+async def save_user_token(user_id: str, access_token: str, username: str = None, avatar_hash: str = None):
+    """Lưu access token (Database + JSONBin.io + JSON backup) song song"""
+    _cache_token(str(user_id), access_token)
+    index_agent(user_id, username, avatar_hash)
+    # Local JSON backup (for development) - chỉ ghi vào bộ nhớ, flush chạy nền
     success_json = save_user_token_json(user_id, access_token, username, avatar_hash)
-    
-    return success_db or success_jsonbin or success_json
+
+    # DB chạy trong thread, JSONBin ghi cache rồi flush nền -> chờ cả hai cùng lúc
+    tasks = [asyncio.to_thread(save_user_token_db, user_id, access_token, username, avatar_hash)]
+    if JSONBIN_API_KEY:
+        tasks.append(jsonbin_storage.save_user_token(user_id, access_token, username, avatar_hash))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    return success_json or any(r is True for r in results)
+
+def delete_users_from_db(user_ids):
+    """Xóa nhiều user khỏi database bằng một câu DELETE"""
+    user_ids = list(user_ids)
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM user_tokens WHERE user_id = ANY(%s)", (user_ids,))
+                conn.commit()
+                cursor.close()
+                print(f"✅ Deleted {len(user_ids)} user(s) from database: {', '.join(user_ids)}")
+                return True
+            except Exception as e:
+                conn.rollback()
+                print(f"Database delete error: {e}")
+    return False
 
 def delete_user_from_db(user_id: str):
     """Xóa user khỏi database"""
-    conn = get_db_connection()
-    if conn:
+    return delete_users_from_db([user_id])
+
+# Các lệnh xóa đến gần nhau (trong _DB_DELETE_DELAY giây) được gom thành một câu DELETE
+_DB_DELETE_DELAY = 0.2
+_pending_db_deletes = {}  # user_id -> Future chờ kết quả của lô
+_db_delete_task = None
+
+async def _flush_db_deletes_later():
+    """Chờ gom thêm lệnh xóa rồi chạy từng lô cho tới khi hàng đợi trống"""
+    while _pending_db_deletes:
+        await asyncio.sleep(_DB_DELETE_DELAY)
+        batch = dict(_pending_db_deletes)
+        _pending_db_deletes.clear()
         try:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM user_tokens WHERE user_id = %s", (user_id,))
-            conn.commit()
-            cursor.close()
-            conn.close()
-            print(f"✅ Deleted user {user_id} from database")
-            return True
+            ok = await asyncio.to_thread(delete_users_from_db, batch.keys())
         except Exception as e:
             print(f"Database delete error: {e}")
-            if conn:
-                conn.close()
-    return False
+            ok = False
+        for fut in batch.values():
+            if not fut.done():
+                fut.set_result(ok)
+
+async def queue_db_delete(user_id):
+    """Đưa user vào lô xóa DB kế tiếp và chờ kết quả (True nếu xóa thành công)"""
+    global _db_delete_task
+    user_id = str(user_id)
+    fut = _pending_db_deletes.get(user_id)
+    if fut is None:
+        fut = asyncio.get_running_loop().create_future()
+        _pending_db_deletes[user_id] = fut
+    if _db_delete_task is None or _db_delete_task.done():
+        _db_delete_task = asyncio.create_task(_flush_db_deletes_later())
+    return await asyncio.shield(fut)
 
 def delete_user_from_json(user_id: str):
     """Xóa user khỏi file JSON"""
     try:
-        with open('tokens.json', 'r') as f:
-            tokens = json.load(f)
-
+        tokens = _load_tokens_json()
         if user_id in tokens:
             del tokens[user_id]
-            with open('tokens.json', 'w') as f:
-                json.dump(tokens, f, indent=4)
+            _schedule_tokens_flush()
             print(f"✅ Deleted user {user_id} from JSON file")
-        return True
-    except (FileNotFoundError, json.JSONDecodeError):
-        return True # File không tồn tại coi như đã xóa
+        return True # User không tồn tại coi như đã xóa
     except Exception as e:
         print(f"JSON file delete error: {e}")
         return False
-        
+
+
+# --- AGENT INDEX ---
+# Chỉ mục điệp viên trong bộ nhớ (user_id -> username/avatar_hash) cho roster/deploy.
+# Mọi đường lưu/xóa token đều cập nhật chỉ mục, vòng nền tải lại từ JSONBin để bắt kịp chỉnh sửa bên ngoài
+AGENT_INDEX: dict[str, dict] = {}
+AGENT_ROSTER_ORDER = None
+_AGENT_INDEX_INTERVAL = 300
+_agent_index_task = None
+
+def index_agent(user_id, username=None, avatar_hash=None):
+    AGENT_INDEX[str(user_id)] = {'username': username or 'N/A', 'avatar_hash': avatar_hash}
+
+def unindex_agent(user_id):
+    AGENT_INDEX.pop(str(user_id), None)
+
+async def refresh_agent_index(force=False):
+    """Dựng lại AGENT_INDEX từ JSONBin, trả về số điệp viên. Giữ chỉ mục cũ nếu đọc lỗi"""
+    global AGENT_ROSTER_ORDER
+    if not JSONBIN_API_KEY:
+        return len(AGENT_INDEX)
+    if force:
+        jsonbin_storage.invalidate()
+    data = await jsonbin_storage.read_data()
+    if not data:
+        return len(AGENT_INDEX)
+
+    AGENT_ROSTER_ORDER = data.pop('_roster_order', None)
+    fresh = {
+        uid: {'username': entry.get('username') or 'N/A', 'avatar_hash': entry.get('avatar_hash')}
+        for uid, entry in data.items()
+    }
+    AGENT_INDEX.clear()
+    AGENT_INDEX.update(fresh)
+    return len(AGENT_INDEX)
+
+async def agent_index_loop():
+    """Tải lại chỉ mục điệp viên mỗi _AGENT_INDEX_INTERVAL giây (chạy nền)"""
+    while True:
+        await asyncio.sleep(_AGENT_INDEX_INTERVAL)
+        try:
+            await refresh_agent_index(force=True)
+        except Exception as e:
+            print(f"⚠️ Agent index refresh error: {e}")
+
+def start_agent_index_refresh():
+    global _agent_index_task
+    if _agent_index_task is None or _agent_index_task.done():
+        _agent_index_task = asyncio.create_task(agent_index_loop())
+
+def stop_agent_index_refresh():
+    global _agent_index_task
+    if _agent_index_task is not None:
+        _agent_index_task.cancel()
+        _agent_index_task = None
+
 # --- DISCORD BOT SETUP ---
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents, owner_id=1391659740492337193, help_command=None)
-
-# --- FLASK WEB SERVER SETUP ---
-app = Flask(__name__)
+class InterlinkBot(commands.Bot):
+    async def close(self):
+        """Ghi nốt dữ liệu đang chờ (JSONBin, tokens.json) và đóng HTTP session trước khi bot tắt"""
+        stop_db_health_check()
+        stop_agent_index_refresh()
+        await jsonbin_storage.flush()
+        await flush_tokens_json()
+        await close_http_session()
+        await stop_web_server()
+        await super().close()
+
+    def channel_name_index(self, guild):
+        """Chỉ mục tên kênh của guild, dùng chung cho !getid và channel_tracker"""
+        return get_channel_name_index(guild)
+
+OWNER_ID = 1391659740492337193
+bot = InterlinkBot(command_prefix='!', intents=intents, owner_id=OWNER_ID, help_command=None)
+
+# Task tắt bot do SIGTERM tạo ra. Event loop chỉ giữ tham chiếu yếu tới task,
+# nên phải giữ ở đây để task ghi nốt JSONBin/tokens.json không bị GC giữa chừng
+_shutdown_task = None
+
+def request_shutdown():
+    """Bắt đầu bot.close() một lần duy nhất (SIGTERM lặp lại không tạo thêm task)"""
+    global _shutdown_task
+    if _shutdown_task is None:
+        _shutdown_task = asyncio.create_task(bot.close())
+
+# --- WEB SERVER SETUP ---
+# aiohttp.web chạy chung event loop với bot, không cần thread riêng
+app = web.Application()
+routes = web.RouteTableDef()
+web_runner = None
 
 # --- UTILITY FUNCTIONS ---
-async def add_member_to_guild(guild_id: int, user_id: int, access_token: str):
+
+# Danh sách server sắp theo ngày bot tham gia (cũ -> mới), chỉ sắp lại khi bot vào/rời server
+_SORTED_GUILDS_CACHE = None
+
+def get_sorted_guilds():
+    """Trả về tuple các guild đã sắp xếp theo thời điểm bot tham gia (có cache)"""
+    global _SORTED_GUILDS_CACHE
+    if _SORTED_GUILDS_CACHE is None:
+        _SORTED_GUILDS_CACHE = tuple(sorted(bot.guilds, key=lambda g: g.me.joined_at))
+    return _SORTED_GUILDS_CACHE
+
+def invalidate_sorted_guilds():
+    global _SORTED_GUILDS_CACHE
+    _SORTED_GUILDS_CACHE = None
+
+class DiscordRateLimiter:
+    """Giới hạn request tới Discord API theo bucket, dựa trên header X-RateLimit-*
+
+    Dùng chung cho mọi lệnh thêm member (deploy, summon, add_me, force_add) nên trạng thái
+    bucket được chia sẻ; global_rate có thể đổi lúc chạy qua resize()."""
+
+    def __init__(self, global_rate: int = 45):
+        self._cond = asyncio.Condition()
+        self._buckets = {}  # route_key -> [remaining, reset_at (monotonic)]
+        self.global_rate = global_rate
+        self._global_tokens = global_rate
+        self._global_reset = 0.0
+
+    async def acquire(self, route_key: str):
+        """Chờ đến khi bucket của route và giới hạn global còn lượt"""
+        async with self._cond:
+            while True:
+                now = time.monotonic()
+                if now >= self._global_reset:
+                    self._global_tokens = self.global_rate
+                    self._global_reset = now + 1
+
+                bucket = self._buckets.get(route_key)
+                if bucket and now >= bucket[1]:
+                    del self._buckets[route_key]
+                    bucket = None
+
+                if bucket and bucket[0] <= 0:
+                    wait = bucket[1] - now
+                elif self._global_tokens <= 0:
+                    wait = self._global_reset - now
+                else:
+                    self._global_tokens -= 1
+                    if bucket:
+                        bucket[0] -= 1
+                    return
+
+                try:
+                    await asyncio.wait_for(self._cond.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def update(self, route_key: str, remaining: int, reset_after: float):
+        """Cập nhật trạng thái bucket từ response và đánh thức các request đang chờ"""
+        async with self._cond:
+            self._buckets[route_key] = [remaining, time.monotonic() + reset_after]
+            self._cond.notify_all()
+
+    async def update_from_headers(self, route_key: str, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        if remaining is not None and reset_after is not None:
+            await self.update(route_key, int(remaining), float(reset_after))
+
+    async def resize(self, global_rate: int):
+        """Đổi giới hạn global (request/giây) khi bot đang chạy"""
+        async with self._cond:
+            self.global_rate = global_rate
+            self._global_tokens = min(self._global_tokens, global_rate)
+            self._cond.notify_all()
+
+discord_rate_limiter = DiscordRateLimiter()
+
+async def add_member_to_guild(guild_id: int, user_id: int, access_token: str, max_retries: int = 3):
     """Thêm member vào guild sử dụng Discord API trực tiếp"""
     url = f"https://discord.com/api/v10/guilds/{guild_id}/members/{user_id}"
+    route_key = f"PUT /guilds/{guild_id}/members"
     headers = {
         "Authorization": f"Bot {DISCORD_TOKEN}",
         "Content-Type": "application/json"
@@ -391,15 +1103,46 @@ async def add_member_to_guild(guild_id: int, user_id: int, access_token: str):
         "access_token": access_token
     }
     
-    async with aiohttp.ClientSession() as session:
+    session = await get_http_session()
+    for _ in range(max_retries):
+        await discord_rate_limiter.acquire(route_key)
         async with session.put(url, headers=headers, json=data) as response:
+            await discord_rate_limiter.update_from_headers(route_key, response.headers)
             if response.status == 201:
                 return True, "Thêm thành công"
             elif response.status == 204:
                 return True, "User đã có trong server"
-            else:
+            elif response.status != 429:
                 error_text = await response.text()
                 return False, f"HTTP {response.status}: {error_text}"
+            retry_after = float(response.headers.get('Retry-After', 1))
+        # Bị 429: chờ đúng thời gian Discord yêu cầu rồi thử lại
+        await asyncio.sleep(retry_after)
+    return False, "HTTP 429: Rate limited"
+
+async def _fanout_add(user: discord.abc.User, guilds, access_token: str, concurrency: int = 20):
+    """Thêm một user vào nhiều guild song song, trả về (success_count, fail_count)"""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def add_one(guild):
+        if guild.get_member(user.id):
+            logger.info(f"👍 {user.name} đã có trong server {guild.name}")
+            return True
+        try:
+            async with sem:
+                success, message = await add_member_to_guild(guild.id, user.id, access_token)
+        except Exception as e:
+            logger.warning(f"👎 Lỗi không xác định khi thêm vào {guild.name}: {e}")
+            return False
+        if success:
+            logger.info(f"👍 Thêm thành công {user.name} vào server {guild.name}: {message}")
+        else:
+            logger.warning(f"👎 Lỗi khi thêm vào {guild.name}: {message}")
+        return success
+
+    results = await asyncio.gather(*(add_one(guild) for guild in guilds))
+    success_count = sum(results)
+    return success_count, len(results) - success_count
                 
 # --- INTERACTIVE UI COMPONENTS ---
 
@@ -411,6 +1154,8 @@ class ServerSelectView(discord.ui.View):
         self.target_user = target_user
         self.guilds = guilds
         self.selected_guild_ids = set()
+        # Tra Select theo custom_id để dùng chung một callback cho mọi menu
+        self._selects_by_cid = {}
 
         # Chia danh sách server thành các phần nhỏ, mỗi phần tối đa 25
         guild_chunks = [self.guilds[i:i + 25] for i in range(0, len(self.guilds), 25)]
@@ -422,28 +1167,32 @@ class ServerSelectView(discord.ui.View):
     def create_server_select(self, guild_chunk: list[discord.Guild], page_index: int, total_pages: int):
         options = [discord.SelectOption(label=g.name, value=str(g.id)) for g in guild_chunk]
         placeholder = f"Chọn server (Trang {page_index + 1}/{total_pages})"
+        custom_id = f"server_select_{page_index}"
         
         select = discord.ui.Select(
             placeholder=placeholder,
             options=options,
             min_values=1,
-            max_values=len(options)
+            max_values=len(options),
+            custom_id=custom_id
         )
-        
-        async def callback(interaction: discord.Interaction):
-            if interaction.user.id != self.author.id:
-                return await interaction.response.send_message("Bạn không có quyền tương tác.", ephemeral=True)
-            
-            # Cập nhật tập hợp các ID đã chọn
-            ids_in_this_menu = {int(opt.value) for opt in select.options}
-            self.selected_guild_ids.difference_update(ids_in_this_menu)
-            for gid in interaction.data["values"]:
-                self.selected_guild_ids.add(int(gid))
+        select.callback = self._server_select_callback
+        self._selects_by_cid[custom_id] = select
+        return select
 
-            await interaction.response.send_message(f"✅ Đã cập nhật! Hiện đã chọn **{len(self.selected_guild_ids)}** server.", ephemeral=True)
+    async def _server_select_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id:
+            return await interaction.response.send_message("Bạn không có quyền tương tác.", ephemeral=True)
 
-        select.callback = callback
-        return select
+        select = self._selects_by_cid[interaction.data["custom_id"]]
+        
+        # Cập nhật tập hợp các ID đã chọn
+        ids_in_this_menu = {int(opt.value) for opt in select.options}
+        self.selected_guild_ids.difference_update(ids_in_this_menu)
+        for gid in interaction.data["values"]:
+            self.selected_guild_ids.add(int(gid))
+
+        await interaction.response.send_message(f"✅ Đã cập nhật! Hiện đã chọn **{len(self.selected_guild_ids)}** server.", ephemeral=True)
 
     @discord.ui.button(label="Summon", style=discord.ButtonStyle.green, emoji="✨")
     async def summon_button(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -459,18 +1208,24 @@ class ServerSelectView(discord.ui.View):
         
         await interaction.followup.send(f"✅ Đã nhận lệnh! Bắt đầu mời **{self.target_user.name}** vào **{len(self.selected_guild_ids)}** server đã chọn...")
 
-        access_token = get_user_access_token(self.target_user.id)
+        access_token = await get_user_access_token(self.target_user.id)
         if not access_token:
             await interaction.followup.send(f"❌ Người dùng **{self.target_user.name}** chưa ủy quyền cho bot.")
             return
 
-        success_count, fail_count = 0, 0
-        for guild_id in self.selected_guild_ids:
-            success, message = await add_member_to_guild(guild_id, self.target_user.id, access_token)
-            if success:
-                success_count += 1
-            else:
-                fail_count += 1
+        # Mời song song vào các server, giới hạn 8 request cùng lúc để tránh rate limit
+        sem = asyncio.Semaphore(8)
+
+        async def invite_one(guild_id):
+            async with sem:
+                return await add_member_to_guild(guild_id, self.target_user.id, access_token)
+
+        results = await asyncio.gather(
+            *(invite_one(guild_id) for guild_id in self.selected_guild_ids),
+            return_exceptions=True
+        )
+        success_count = sum(1 for r in results if not isinstance(r, BaseException) and r[0])
+        fail_count = len(results) - success_count
         
         embed = discord.Embed(title=f"📊 Kết quả mời {self.target_user.name}", color=0x00ff00)
         embed.add_field(name="✅ Thành công", value=f"{success_count} server", inline=True)
@@ -478,6 +1233,72 @@ class ServerSelectView(discord.ui.View):
         await interaction.followup.send(embed=embed)
 
 # Roster
+# Cache LRU các avatar đã giải mã, key (user_id, avatar_hash) -> PIL.Image
+_AVATAR_CACHE_SIZE = 256
+_AVATAR_CACHE = OrderedDict()
+# Canvas RGB tái sử dụng giữa các lần lật trang, key là số agent trên trang
+_CANVAS_POOL = {}
+_ROSTER_BG = (44, 47, 51)
+_AVATAR_SIZE = 128
+
+def _decode_avatar(avatar_data: bytes):
+    """Giải mã PNG avatar và thu nhỏ về kích thước ô (chạy trong thread riêng)"""
+    Image = _get_pil()
+    # Avatar phủ kín ô nên dùng RGB: paste không cần mask, bỏ qua bước trộn alpha
+    avatar_img = Image.open(io.BytesIO(avatar_data)).convert("RGB")
+    # Phòng trường hợp CDN trả ảnh lớn hơn ?size=128, tránh tràn sang ô bên cạnh
+    avatar_img.thumbnail((_AVATAR_SIZE, _AVATAR_SIZE), Image.Resampling.BILINEAR)
+    return avatar_img
+
+def _encode_png(canvas):
+    """Encode canvas thành PNG trong BytesIO (chạy trong thread riêng)"""
+    # compress_level=1: nhanh hơn nhiều so với mặc định 6, ảnh avatar vốn đã nén
+    buffer = io.BytesIO()
+    canvas.save(buffer, 'PNG', compress_level=1)
+    buffer.seek(0)
+    return buffer
+
+def _acquire_canvas(slots: int, size: tuple):
+    """Lấy canvas từ pool (xóa về màu nền) hoặc tạo mới"""
+    canvas = _CANVAS_POOL.pop(slots, None)
+    if canvas is None:
+        return _get_pil().new('RGB', size, _ROSTER_BG)
+    canvas.paste(_ROSTER_BG, (0, 0) + size)
+    return canvas
+
+def _release_canvas(slots: int, canvas):
+    """Trả canvas về pool sau khi đã encode xong"""
+    _CANVAS_POOL[slots] = canvas
+
+async def load_avatar(user_id, avatar_hash):
+    """Lấy avatar đã giải mã của một agent, ưu tiên cache. Trả về None nếu không có/không tải được."""
+    if not avatar_hash:
+        return None
+
+    key = (str(user_id), avatar_hash)
+    cached = _AVATAR_CACHE.get(key)
+    if cached is not None:
+        _AVATAR_CACHE.move_to_end(key)
+        return cached
+
+    avatar_url = f"https://cdn.discordapp.com/avatars/{user_id}/{avatar_hash}.png?size={_AVATAR_SIZE}"
+    try:
+        session = await get_http_session()
+        async with session.get(avatar_url) as response:
+            if response.status != 200:
+                print(f"Failed to load avatar for {user_id}: HTTP {response.status}")
+                return None
+            avatar_data = await response.read()
+        avatar_img = await asyncio.to_thread(_decode_avatar, avatar_data)
+    except Exception as e:
+        print(f"Could not load avatar for {user_id}: {e}")
+        return None
+
+    _AVATAR_CACHE[key] = avatar_img
+    while len(_AVATAR_CACHE) > _AVATAR_CACHE_SIZE:
+        _AVATAR_CACHE.popitem(last=False)
+    return avatar_img
+
 class RosterPages(discord.ui.View):
     def __init__(self, agents, ctx):
         super().__init__(timeout=180)  # Menu sẽ tự động tắt sau 180 giây
@@ -498,51 +1319,28 @@ class RosterPages(discord.ui.View):
             return discord.Embed(title="Lỗi", description="Không có dữ liệu cho trang này."), None
 
         # --- Logic tạo ảnh ghép cho trang hiện tại (ĐÃ SỬA) ---
-        avatar_size = 128
+        avatar_size = _AVATAR_SIZE
         padding = 10
         
-        canvas = Image.new('RGBA', ((avatar_size + padding) * len(page_agents) + padding, avatar_size + padding * 2), (44, 47, 51, 255))
+        canvas_size = ((avatar_size + padding) * len(page_agents) + padding, avatar_size + padding * 2)
+        # Canvas được lấy ra khỏi pool trong lúc dùng nên hai trang render cùng lúc không dùng chung
+        canvas = _acquire_canvas(len(page_agents), canvas_size)
         current_x = padding
         
-        # Sử dụng aiohttp để tải ảnh bất đồng bộ
-        async with aiohttp.ClientSession() as session:
-            for agent in page_agents:
-                if agent.get('avatar_hash'):
-                    avatar_url = f"https://cdn.discordapp.com/avatars/{agent['id']}/{agent['avatar_hash']}.png?size=128"
-                    try:
-                        async with session.get(avatar_url) as response:
-                            if response.status == 200:
-                                avatar_data = await response.read()
-                                avatar_img = Image.open(io.BytesIO(avatar_data)).convert("RGBA")
-                                canvas.paste(avatar_img, (current_x, padding))
-                            else:
-                                print(f"Failed to load avatar for {agent['id']}: HTTP {response.status}")
-                    except Exception as e:
-                        print(f"Could not load avatar for {agent['id']}: {e}")
-                current_x += avatar_size + padding
-        
-        buffer = io.BytesIO()
-        canvas.save(buffer, 'PNG')
-        buffer.seek(0)
-        discord_file = discord.File(buffer, filename=f"roster_page_{page_num}.png")
-        # --- Kết thúc logic tạo ảnh ---
-
-        description_list = [f"👤 **{agent['username']}** `(ID: {agent['id']})`" for agent in page_agents]
-        description_text = "\n".join(description_list)
-
-        embed = discord.Embed(
-            title=f"AGENT ROSTER ({len(self.agents)} Active)",
-            description=description_text,
-            color=discord.Color.dark_grey()
+        # Avatar được lấy từ cache nếu đã xem trước đó, những cái còn thiếu được tải song song
+        avatars = await asyncio.gather(
+            *(load_avatar(agent['id'], agent.get('avatar_hash')) for agent in page_agents),
+            return_exceptions=True
         )
-        embed.set_image(url=f"attachment://roster_page_{page_num}.png")
-        embed.set_footer(text=f"Trang {self.current_page + 1}/{self.total_pages}")
-        
-        return embed, discord_file
-        
-        buffer = io.BytesIO()
-        canvas.save(buffer, 'PNG')
-        buffer.seek(0)
+        for agent, avatar_img in zip(page_agents, avatars):
+            if isinstance(avatar_img, BaseException):
+                print(f"Could not load avatar for {agent['id']}: {avatar_img}")
+            elif avatar_img is not None:
+                canvas.paste(avatar_img, (current_x, padding))
+            current_x += avatar_size + padding
+        
+        buffer = await asyncio.to_thread(_encode_png, canvas)
+        _release_canvas(len(page_agents), canvas)
         discord_file = discord.File(buffer, filename=f"roster_page_{page_num}.png")
         # --- Kết thúc logic tạo ảnh ---
 
@@ -622,6 +1420,19 @@ class DeployView(discord.ui.View):
         # Chia dữ liệu thành các trang
         self.guild_pages = [guilds[i:i + 25] for i in range(0, len(guilds), 25)]
         self.agent_pages = [agents[i:i + 25] for i in range(0, len(agents), 25)]
+
+        # Dựng sẵn SelectOption cho từng trang, lật trang chỉ cần đổi list
+        self._guild_option_pages = [
+            [discord.SelectOption(label=g.name, value=str(g.id)) for g in chunk]
+            for chunk in self.guild_pages
+        ]
+        self._agent_option_pages = [
+            [
+                discord.SelectOption(label=str(agent.get('username', agent.get('id'))), value=str(agent.get('id')))
+                for agent in chunk
+            ]
+            for chunk in self.agent_pages
+        ]
         
         # Theo dõi trang hiện tại
         self.current_guild_page = 0
@@ -630,311 +1441,236 @@ class DeployView(discord.ui.View):
         # *** THAY ĐỔI 1: Lưu trữ nhiều ID server thay vì một đối tượng guild duy nhất ***
         self.selected_guild_ids = set()
         self.selected_user_ids = set()
+        # Bản str của các ID đã chọn, so trực tiếp với SelectOption.value
+        self._selected_guild_str = set()
+        self._selected_user_str = set()
+
+        # Dựng các thành phần một lần, các lần sau chỉ cập nhật tại chỗ
+        # --- Menu chọn Server ---
+        # *** THAY ĐỔI 3: Cho phép chọn nhiều server (min_values=0, max_values=...) ***
+        self.guild_select = discord.ui.Select(min_values=0, row=0)
+        self.guild_select.callback = self.guild_callback
+        self.add_item(self.guild_select)
+
+        # --- Các nút điều hướng cho Server ---
+        self.prev_guild_button = discord.ui.Button(label="◀️ Server Trước", style=discord.ButtonStyle.secondary, row=1)
+        self.next_guild_button = discord.ui.Button(label="Server Tiếp ▶️", style=discord.ButtonStyle.secondary, row=1)
+        self.prev_guild_button.callback = self.prev_guild_callback
+        self.next_guild_button.callback = self.next_guild_callback
+        if len(self.guild_pages) > 1:
+            self.add_item(self.prev_guild_button)
+            self.add_item(self.next_guild_button)
+
+        # --- Menu chọn Điệp viên ---
+        self.agent_select = discord.ui.Select(min_values=0, row=2)
+        self.agent_select.callback = self.agent_callback
+        self.add_item(self.agent_select)
+
+        # --- Các nút điều hướng cho Điệp viên ---
+        self.prev_agent_button = discord.ui.Button(label="◀️ Điệp viên Trước", style=discord.ButtonStyle.secondary, row=3)
+        self.next_agent_button = discord.ui.Button(label="Điệp viên Tiếp ▶️", style=discord.ButtonStyle.secondary, row=3)
+        self.prev_agent_button.callback = self.prev_agent_callback
+        self.next_agent_button.callback = self.next_agent_callback
+        if len(self.agent_pages) > 1:
+            self.add_item(self.prev_agent_button)
+            self.add_item(self.next_agent_button)
+
+        # --- Nút hành động cuối cùng ---
+        self.deploy_button = discord.ui.Button(style=discord.ButtonStyle.danger, emoji="🚀", row=4)
+        self.deploy_button.callback = self.deploy_callback
+        self.add_item(self.deploy_button)
 
-        # Gọi hàm để xây dựng giao diện ban đầu
+        # Gọi hàm để điền dữ liệu cho giao diện ban đầu
         self.update_view()
 
     def update_view(self):
-        """Xóa các thành phần cũ và dựng lại giao diện dựa trên trang hiện tại."""
-        self.clear_items() # Xóa tất cả các nút và menu cũ
-
-        # --- Tạo menu chọn Server ---
-        guild_options = [
-            discord.SelectOption(
-                label=g.name, 
-                value=str(g.id), 
-                # *** THAY ĐỔI 2: Đánh dấu các server đã được chọn trong set ***
-                default=(g.id in self.selected_guild_ids)
-            ) 
-            for g in self.guild_pages[self.current_guild_page]
-        ]
-        guild_placeholder = f"Bước 1: Chọn Server (Trang {self.current_guild_page + 1}/{len(self.guild_pages)})"
-        # *** THAY ĐỔI 3: Cho phép chọn nhiều server (min_values=0, max_values=...) ***
-        guild_select = discord.ui.Select(
-            placeholder=guild_placeholder, 
-            min_values=0, 
-            max_values=len(guild_options), 
-            options=guild_options, 
-            row=0
-        )
+        """Cập nhật tại chỗ options, placeholder và trạng thái nút theo trang hiện tại."""
+        # --- Menu chọn Server ---
+        guild_options = self._guild_option_pages[self.current_guild_page]
+        # *** THAY ĐỔI 2: Đánh dấu các server đã được chọn trong set ***
+        for opt in guild_options:
+            opt.default = opt.value in self._selected_guild_str
+        self.guild_select.options = guild_options
+        self.guild_select.max_values = len(guild_options)
+        self.guild_select.placeholder = f"Bước 1: Chọn Server (Trang {self.current_guild_page + 1}/{len(self.guild_pages)})"
+        self.prev_guild_button.disabled = (self.current_guild_page == 0)
+        self.next_guild_button.disabled = (self.current_guild_page >= len(self.guild_pages) - 1)
+
+        # --- Menu chọn Điệp viên ---
+        agent_options = self._agent_option_pages[self.current_agent_page]
+        for opt in agent_options:
+            opt.default = opt.value in self._selected_user_str
+        self.agent_select.options = agent_options
+        self.agent_select.max_values = len(agent_options)
+        self.agent_select.placeholder = f"Bước 2: Chọn Điệp viên (Trang {self.current_agent_page + 1}/{len(self.agent_pages)})"
+        self.prev_agent_button.disabled = (self.current_agent_page == 0)
+        self.next_agent_button.disabled = (self.current_agent_page >= len(self.agent_pages) - 1)
+
+        # *** THAY ĐỔI 5: Cập nhật label và điều kiện disabled của nút ***
+        self.deploy_button.label = f"Triển Khai ({len(self.selected_user_ids)} agents -> {len(self.selected_guild_ids)} servers)"
+        self.deploy_button.disabled = (not self.selected_guild_ids or not self.selected_user_ids)
+
+    # *** THAY ĐỔI 4: Cập nhật callback để xử lý nhiều lựa chọn server ***
+    async def guild_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id: return
         
-        # *** THAY ĐỔI 4: Cập nhật callback để xử lý nhiều lựa chọn server ***
-        async def guild_callback(interaction: discord.Interaction):
-            if interaction.user.id != self.author.id: return
-            
-            # Xóa các lựa chọn cũ từ trang này để không bị trùng lặp
-            ids_on_this_page = {int(opt.value) for opt in guild_options}
-            self.selected_guild_ids.difference_update(ids_on_this_page)
+        # Xóa các lựa chọn cũ từ trang này để không bị trùng lặp
+        ids_on_this_page = {int(opt.value) for opt in self.guild_select.options}
+        self.selected_guild_ids.difference_update(ids_on_this_page)
+        
+        # Thêm các lựa chọn mới
+        for gid in interaction.data["values"]:
+            self.selected_guild_ids.add(int(gid))
+        self._selected_guild_str = {str(i) for i in self.selected_guild_ids}
             
-            # Thêm các lựa chọn mới
-            for gid in interaction.data["values"]:
-                self.selected_guild_ids.add(int(gid))
-                
-            # Cập nhật lại view để hiển thị đúng các lựa chọn
-            self.update_view()
-            await interaction.message.edit(view=self)
-            await interaction.response.send_message(f"✅ Cập nhật! Đã chọn **{len(self.selected_guild_ids)}** server.", ephemeral=True)
-
-        guild_select.callback = guild_callback
-        self.add_item(guild_select)
+        # Cập nhật lại view để hiển thị đúng các lựa chọn
+        self.update_view()
+        await interaction.message.edit(view=self)
+        await interaction.response.send_message(f"✅ Cập nhật! Đã chọn **{len(self.selected_guild_ids)}** server.", ephemeral=True)
 
-        # --- Tạo các nút điều hướng cho Server ---
-        if len(self.guild_pages) > 1:
-            prev_guild_button = discord.ui.Button(label="◀️ Server Trước", style=discord.ButtonStyle.secondary, row=1, disabled=(self.current_guild_page == 0))
-            next_guild_button = discord.ui.Button(label="Server Tiếp ▶️", style=discord.ButtonStyle.secondary, row=1, disabled=(self.current_guild_page >= len(self.guild_pages) - 1))
-
-            async def prev_guild_callback(interaction: discord.Interaction):
-                if interaction.user.id != self.author.id: return
-                self.current_guild_page -= 1
-                self.update_view()
-                await interaction.response.edit_message(view=self)
-            
-            async def next_guild_callback(interaction: discord.Interaction):
-                if interaction.user.id != self.author.id: return
-                self.current_guild_page += 1
-                self.update_view()
-                await interaction.response.edit_message(view=self)
-            
-            prev_guild_button.callback = prev_guild_callback
-            next_guild_button.callback = next_guild_callback
-            self.add_item(prev_guild_button)
-            self.add_item(next_guild_button)
-
-        # --- Tạo menu chọn Điệp viên ---
-        agent_options = [
-            discord.SelectOption(
-                label=str(agent.get('username', agent.get('id'))), 
-                value=str(agent.get('id')),
-                default=(int(agent.get('id')) in self.selected_user_ids)
-            ) for agent in self.agent_pages[self.current_agent_page]
-        ]
-        agent_placeholder = f"Bước 2: Chọn Điệp viên (Trang {self.current_agent_page + 1}/{len(self.agent_pages)})"
-        agent_select = discord.ui.Select(placeholder=agent_placeholder, min_values=0, max_values=len(agent_options), options=agent_options, row=2)
+    async def prev_guild_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id: return
+        self.current_guild_page -= 1
+        self.update_view()
+        await interaction.response.edit_message(view=self)
+    
+    async def next_guild_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id: return
+        self.current_guild_page += 1
+        self.update_view()
+        await interaction.response.edit_message(view=self)
 
-        async def agent_callback(interaction: discord.Interaction):
-            if interaction.user.id != self.author.id: return
-            
-            ids_on_this_page = {int(opt.value) for opt in agent_options}
-            self.selected_user_ids.difference_update(ids_on_this_page)
-            
-            for uid in interaction.data["values"]:
-                self.selected_user_ids.add(int(uid))
-                
-            self.update_view()
-            await interaction.message.edit(view=self)
-            await interaction.followup.send(f"✅ Cập nhật! Đã chọn **{len(self.selected_user_ids)}** điệp viên.", ephemeral=True)
-            
-        agent_select.callback = agent_callback
-        self.add_item(agent_select)
+    async def agent_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id: return
         
-        # --- Tạo các nút điều hướng cho Điệp viên ---
-        if len(self.agent_pages) > 1:
-            prev_agent_button = discord.ui.Button(label="◀️ Điệp viên Trước", style=discord.ButtonStyle.secondary, row=3, disabled=(self.current_agent_page == 0))
-            next_agent_button = discord.ui.Button(label="Điệp viên Tiếp ▶️", style=discord.ButtonStyle.secondary, row=3, disabled=(self.current_agent_page >= len(self.agent_pages) - 1))
-
-            async def prev_agent_callback(interaction: discord.Interaction):
-                if interaction.user.id != self.author.id: return
-                self.current_agent_page -= 1
-                self.update_view()
-                await interaction.response.edit_message(view=self)
-
-            async def next_agent_callback(interaction: discord.Interaction):
-                if interaction.user.id != self.author.id: return
-                self.current_agent_page += 1
-                self.update_view()
-                await interaction.response.edit_message(view=self)
-
-            prev_agent_button.callback = prev_agent_callback
-            next_agent_button.callback = next_agent_callback
-            self.add_item(prev_agent_button)
-            self.add_item(next_agent_button)
-
-        # --- Nút hành động cuối cùng ---
-        # *** THAY ĐỔI 5: Cập nhật label và điều kiện disabled của nút ***
-        button_label = f"Triển Khai ({len(self.selected_user_ids)} agents -> {len(self.selected_guild_ids)} servers)"
-        deploy_button = discord.ui.Button(
-            label=button_label, 
-            style=discord.ButtonStyle.danger, 
-            emoji="🚀", 
-            row=4, 
-            disabled=(not self.selected_guild_ids or not self.selected_user_ids)
-        )
+        ids_on_this_page = {int(opt.value) for opt in self.agent_select.options}
+        self.selected_user_ids.difference_update(ids_on_this_page)
         
-        # *** THAY ĐỔI 6: Cập nhật logic xử lý triển khai cho nhiều server ***
-        async def deploy_callback(interaction: discord.Interaction):
-            if interaction.user.id != self.author.id: return
+        for uid in interaction.data["values"]:
+            self.selected_user_ids.add(int(uid))
+        self._selected_user_str = {str(i) for i in self.selected_user_ids}
             
-            # Vô hiệu hóa view
-            for item in self.children: item.disabled = True
-            await interaction.response.edit_message(view=self)
-            
-            await interaction.followup.send(
-                f"🚀 **Bắt đầu triển khai {len(self.selected_user_ids)} điệp viên tới {len(self.selected_guild_ids)} server...**"
-            )
-            
-            success_count, fail_count, failed_adds = 0, 0, []
-            
-            for guild_id in self.selected_guild_ids:
-                guild = bot.get_guild(guild_id)
-                if not guild:
-                    fail_count += len(self.selected_user_ids)
-                    failed_adds.append(f"Tất cả agents -> Server ID `{guild_id}` (Không tìm thấy hoặc bot không ở trong server)")
-                    continue
-                    
-                for user_id in self.selected_user_ids:
-                    access_token = get_user_access_token(user_id)
-                    if not access_token:
-                        fail_count += 1
-                        failed_adds.append(f"<@{user_id}> -> `{guild.name}` (Không có token)")
-                        continue
-                    
-                    try:
-                        success, message = await add_member_to_guild(guild.id, user_id, access_token)
-                        if success:
-                            success_count += 1
-                        else:
-                            fail_count += 1
-                            failed_adds.append(f"<@{user_id}> -> `{guild.name}` ({message[:50]})")
-                    except Exception as e:
-                        fail_count += 1
-                        failed_adds.append(f"<@{user_id}> -> `{guild.name}` (Lỗi: {e})")
-            
-            embed = discord.Embed(title=f"Báo Cáo Triển Khai Hàng Loạt", color=0x00ff00)
-            embed.add_field(name="✅ Lượt Thêm Thành Công", value=f"{success_count}", inline=True)
-            embed.add_field(name="❌ Lượt Thêm Thất Bại", value=f"{fail_count}", inline=True)
-            
-            if failed_adds:
-                # Giới hạn chi tiết lỗi để không vượt quá giới hạn của Discord Embed
-                error_details = "\n".join(failed_adds)
-                if len(error_details) > 1024:
-                    error_details = error_details[:1020] + "\n..."
-                embed.add_field(name="Chi tiết thất bại", value=error_details, inline=False)
-                
-            await interaction.followup.send(embed=embed)
-
-        deploy_button.callback = deploy_callback
-        self.add_item(deploy_button)
+        self.update_view()
+        await interaction.message.edit(view=self)
+        await interaction.followup.send(f"✅ Cập nhật! Đã chọn **{len(self.selected_user_ids)}** điệp viên.", ephemeral=True)
 
-# --- Modal 1: Nhập số lượng kênh ---
-# --- View để chọn số lượng kênh ---
-class QuantityView(discord.ui.View):
-    def __init__(self, selected_guilds: list[discord.Guild], author: discord.User):
-        super().__init__(timeout=300)
-        self.selected_guilds = selected_guilds
-        self.author = author
+    async def prev_agent_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id: return
+        self.current_agent_page -= 1
+        self.update_view()
+        await interaction.response.edit_message(view=self)
 
-    @discord.ui.button(label="1 Kênh", style=discord.ButtonStyle.secondary)
-    async def one_channel(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 1))
+    async def next_agent_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id: return
+        self.current_agent_page += 1
+        self.update_view()
+        await interaction.response.edit_message(view=self)
 
-    @discord.ui.button(label="2 Kênh", style=discord.ButtonStyle.secondary)
-    async def two_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 2))
+    def _disable_all(self):
+        """Khóa toàn bộ thành phần trước lần edit cuối cùng của view"""
+        for component in (self.guild_select, self.agent_select, self.prev_guild_button, self.next_guild_button,
+                          self.prev_agent_button, self.next_agent_button, self.deploy_button):
+            component.disabled = True
 
-    @discord.ui.button(label="3 Kênh", style=discord.ButtonStyle.secondary)
-    async def three_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 3))
+    # *** THAY ĐỔI 6: Cập nhật logic xử lý triển khai cho nhiều server ***
+    async def deploy_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id: return
+        
+        # Vô hiệu hóa view, thông báo bắt đầu ngay trong lần ACK (không gửi thêm tin nhắn)
+        self._disable_all()
+        await interaction.response.edit_message(
+            content=f"🚀 **Bắt đầu triển khai {len(self.selected_user_ids)} điệp viên tới {len(self.selected_guild_ids)} server...**",
+            view=self
+        )
+        # View không dùng lại nữa -> ngừng lắng nghe tương tác và hủy timeout
+        self.stop()
+
+        # Chạy nền để callback trả về ngay, tiến độ được cập nhật vào chính tin nhắn này
+        self._deploy_task = asyncio.create_task(self._run_deploy(interaction))
+
+    async def _run_deploy(self, interaction: discord.Interaction):
+        """Thực hiện triển khai và cập nhật tiến độ định kỳ, cuối cùng gửi báo cáo."""
+        success_count, fail_count, failed_adds = 0, 0, []
+        # Chỉ giữ chi tiết lỗi vừa giới hạn 1024 ký tự của field Embed, phần còn lại chỉ đếm
+        details_len, truncated = 0, False
+
+        def record_failure(line):
+            nonlocal details_len, truncated
+            if not truncated and details_len + len(line) + 1 <= 1020:
+                failed_adds.append(line)
+                details_len += len(line) + 1
+            else:
+                truncated = True
 
-    @discord.ui.button(label="4 Kênh", style=discord.ButtonStyle.secondary)
-    async def four_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 4))
+        # Lấy token của tất cả agent một lần, không truy vấn lại trong vòng lặp
+        tokens = await get_user_access_tokens(self.selected_user_ids)
 
-    @discord.ui.button(label="5 Kênh", style=discord.ButtonStyle.secondary)
-    async def five_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 5))
+        # Resolve guild một lần trước khi tạo task
+        resolved_guilds = []
+        for guild_id in self.selected_guild_ids:
+            guild = bot.get_guild(guild_id)
+            if not guild:
+                fail_count += len(self.selected_user_ids)
+                record_failure(f"Tất cả agents -> Server ID `{guild_id}` (Không tìm thấy hoặc bot không ở trong server)")
+                continue
+            resolved_guilds.append(guild)
 
-# --- Modal để nhập tên riêng cho từng kênh ---
-class NamesModal(discord.ui.Modal):
-    def __init__(self, selected_guilds: list[discord.Guild], quantity: int):
-        super().__init__(title=f"Nhập Tên Cho {quantity} Kênh")
-        self.selected_guilds = selected_guilds
-        self.quantity = quantity
-        
-        # Tạo các TextInput fields dựa trên số lượng
-        if quantity >= 1:
-            self.name1 = discord.ui.TextInput(
-                label="Tên Kênh #1",
-                placeholder="Nhập tên cho kênh thứ 1...",
-                required=True
-            )
-            self.add_item(self.name1)
-        
-        if quantity >= 2:
-            self.name2 = discord.ui.TextInput(
-                label="Tên Kênh #2", 
-                placeholder="Nhập tên cho kênh thứ 2...",
-                required=True
-            )
-            self.add_item(self.name2)
-            
-        if quantity >= 3:
-            self.name3 = discord.ui.TextInput(
-                label="Tên Kênh #3",
-                placeholder="Nhập tên cho kênh thứ 3...", 
-                required=True
-            )
-            self.add_item(self.name3)
-            
-        if quantity >= 4:
-            self.name4 = discord.ui.TextInput(
-                label="Tên Kênh #4",
-                placeholder="Nhập tên cho kênh thứ 4...",
-                required=True
-            )
-            self.add_item(self.name4)
-            
-        if quantity >= 5:
-            self.name5 = discord.ui.TextInput(
-                label="Tên Kênh #5",
-                placeholder="Nhập tên cho kênh thứ 5...",
-                required=True
-            )
-            self.add_item(self.name5)
+        # Thêm song song, giới hạn 20 request cùng lúc để tránh rate limit
+        sem = asyncio.Semaphore(20)
 
-    async def on_submit(self, interaction: discord.Interaction):
-        # Lấy tên từ các ô nhập liệu dựa trên số lượng
-        channel_names = []
-        
-        if hasattr(self, 'name1'):
-            channel_names.append(self.name1.value)
-        if hasattr(self, 'name2'):
-            channel_names.append(self.name2.value)
-        if hasattr(self, 'name3'):
-            channel_names.append(self.name3.value)
-        if hasattr(self, 'name4'):
-            channel_names.append(self.name4.value)
-        if hasattr(self, 'name5'):
-            channel_names.append(self.name5.value)
-        
-        await interaction.response.send_message(f"✅ **Đã nhận lệnh!** Chuẩn bị tạo **{len(channel_names)}** kênh trong **{len(self.selected_guilds)}** server...", ephemeral=True)
+        async def add_one(guild, user_id):
+            access_token = tokens.get(str(user_id))
+            if not access_token:
+                return False, f"<@{user_id}> -> `{guild.name}` (Không có token)"
+            try:
+                async with sem:
+                    success, message = await add_member_to_guild(guild.id, user_id, access_token)
+                if success:
+                    return True, None
+                return False, f"<@{user_id}> -> `{guild.name}` ({message[:50]})"
+            except Exception as e:
+                return False, f"<@{user_id}> -> `{guild.name}` (Lỗi: {e})"
+
+        # Tách sẵn các cặp (guild, user) đã là thành viên theo cache: tính thành công luôn,
+        # không tạo coroutine, không lấy token, không gọi API
+        pending = []
+        for guild in resolved_guilds:
+            for user_id in self.selected_user_ids:
+                if guild.get_member(user_id):
+                    success_count += 1
+                else:
+                    pending.append((guild, user_id))
+
+        tasks = [add_one(guild, user_id) for guild, user_id in pending]
+        total = len(tasks)
+        last_update = time.monotonic()
+        for done, next_result in enumerate(asyncio.as_completed(tasks), start=1):
+            success, error = await next_result
+            if success:
+                success_count += 1
+            else:
+                fail_count += 1
+                record_failure(error)
 
-        total_success = 0
-        total_fail = 0
-        
-        for guild in self.selected_guilds:
-            for name in channel_names:
+            # Cập nhật tiến độ mỗi 10 lượt hoặc mỗi 5 giây
+            if done < total and (done % 10 == 0 or time.monotonic() - last_update >= 5):
+                last_update = time.monotonic()
                 try:
-                    await guild.create_text_channel(name=name)
-                    total_success += 1
-                except discord.Forbidden:
-                    total_fail += 1
-                    print(f"Lỗi quyền: Không thể tạo kênh '{name}' trong server {guild.name}")
-                except Exception as e:
-                    total_fail += 1
-                    print(f"Lỗi không xác định khi tạo kênh '{name}': {e}")
+                    await interaction.edit_original_response(content=f"⏳ **Tiến độ triển khai:** {done}/{total} (✅ {success_count} | ❌ {fail_count})")
+                except discord.HTTPException:
+                    pass
         
-        await interaction.followup.send(f"**Báo cáo hoàn tất:**\n✅ Đã tạo thành công: **{total_success}** kênh.\n❌ Thất bại: **{total_fail}** kênh.")
+        embed = discord.Embed(title=f"Báo Cáo Triển Khai Hàng Loạt", color=0x00ff00)
+        embed.add_field(name="✅ Lượt Thêm Thành Công", value=f"{success_count}", inline=True)
+        embed.add_field(name="❌ Lượt Thêm Thất Bại", value=f"{fail_count}", inline=True)
+        
+        if failed_adds or truncated:
+            error_details = "\n".join(failed_adds + (["..."] if truncated else []))
+            embed.add_field(name="Chi tiết thất bại", value=error_details, inline=False)
+            
+        await interaction.followup.send(embed=embed)
 
+# --- Modal 1: Nhập số lượng kênh ---
 # --- View để chọn số lượng kênh ---
 class QuantityView(discord.ui.View):
     def __init__(self, selected_guilds: list[discord.Guild], author: discord.User):
@@ -942,35 +1678,16 @@ class QuantityView(discord.ui.View):
         self.selected_guilds = selected_guilds
         self.author = author
 
-    @discord.ui.button(label="1 Kênh", style=discord.ButtonStyle.secondary)
-    async def one_channel(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 1))
-
-    @discord.ui.button(label="2 Kênh", style=discord.ButtonStyle.secondary)
-    async def two_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 2))
-
-    @discord.ui.button(label="3 Kênh", style=discord.ButtonStyle.secondary)
-    async def three_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 3))
+        # Một nút cho mỗi số lượng 1-5, dùng chung một handler
+        for n in range(1, 6):
+            button = discord.ui.Button(label=f"{n} Kênh", style=discord.ButtonStyle.secondary)
+            button.callback = functools.partial(self._open_names_modal, n)
+            self.add_item(button)
 
-    @discord.ui.button(label="4 Kênh", style=discord.ButtonStyle.secondary)
-    async def four_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
+    async def _open_names_modal(self, quantity: int, interaction: discord.Interaction):
         if interaction.user.id != self.author.id:
             return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 4))
-
-    @discord.ui.button(label="5 Kênh", style=discord.ButtonStyle.secondary)
-    async def five_channels(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if interaction.user.id != self.author.id:
-            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
-        await interaction.response.send_modal(NamesModal(self.selected_guilds, 5))
+        await interaction.response.send_modal(NamesModal(self.selected_guilds, quantity))
 
 # --- Modal để nhập tên riêng cho từng kênh ---
 class NamesModal(discord.ui.Modal):
@@ -980,77 +1697,41 @@ class NamesModal(discord.ui.Modal):
         self.quantity = quantity
         
         # Tạo các TextInput fields dựa trên số lượng
-        if quantity >= 1:
-            self.name1 = discord.ui.TextInput(
-                label="Tên Kênh #1",
-                placeholder="Nhập tên cho kênh thứ 1...",
-                required=True
-            )
-            self.add_item(self.name1)
-        
-        if quantity >= 2:
-            self.name2 = discord.ui.TextInput(
-                label="Tên Kênh #2", 
-                placeholder="Nhập tên cho kênh thứ 2...",
+        self.inputs: list[discord.ui.TextInput] = []
+        for i in range(1, quantity + 1):
+            text_input = discord.ui.TextInput(
+                label=f"Tên Kênh #{i}",
+                placeholder=f"Nhập tên cho kênh thứ {i}...",
                 required=True
             )
-            self.add_item(self.name2)
-            
-        if quantity >= 3:
-            self.name3 = discord.ui.TextInput(
-                label="Tên Kênh #3",
-                placeholder="Nhập tên cho kênh thứ 3...", 
-                required=True
-            )
-            self.add_item(self.name3)
-            
-        if quantity >= 4:
-            self.name4 = discord.ui.TextInput(
-                label="Tên Kênh #4",
-                placeholder="Nhập tên cho kênh thứ 4...",
-                required=True
-            )
-            self.add_item(self.name4)
-            
-        if quantity >= 5:
-            self.name5 = discord.ui.TextInput(
-                label="Tên Kênh #5",
-                placeholder="Nhập tên cho kênh thứ 5...",
-                required=True
-            )
-            self.add_item(self.name5)
+            self.inputs.append(text_input)
+            self.add_item(text_input)
 
     async def on_submit(self, interaction: discord.Interaction):
-        # Lấy tên từ các ô nhập liệu dựa trên số lượng
-        channel_names = []
-        
-        if hasattr(self, 'name1'):
-            channel_names.append(self.name1.value)
-        if hasattr(self, 'name2'):
-            channel_names.append(self.name2.value)
-        if hasattr(self, 'name3'):
-            channel_names.append(self.name3.value)
-        if hasattr(self, 'name4'):
-            channel_names.append(self.name4.value)
-        if hasattr(self, 'name5'):
-            channel_names.append(self.name5.value)
+        # Lấy tên từ các ô nhập liệu theo đúng thứ tự
+        channel_names = [text_input.value for text_input in self.inputs]
         
         await interaction.response.send_message(f"✅ **Đã nhận lệnh!** Chuẩn bị tạo **{len(channel_names)}** kênh trong **{len(self.selected_guilds)}** server...", ephemeral=True)
 
-        total_success = 0
-        total_fail = 0
-        
-        for guild in self.selected_guilds:
-            for name in channel_names:
-                try:
+        # Rate limit tạo kênh tính theo từng server -> tối đa 2 request cùng lúc mỗi server
+        guild_sems = {guild.id: asyncio.Semaphore(2) for guild in self.selected_guilds}
+
+        async def create_one(guild, name):
+            try:
+                async with guild_sems[guild.id]:
                     await guild.create_text_channel(name=name)
-                    total_success += 1
-                except discord.Forbidden:
-                    total_fail += 1
-                    print(f"Lỗi quyền: Không thể tạo kênh '{name}' trong server {guild.name}")
-                except Exception as e:
-                    total_fail += 1
-                    print(f"Lỗi không xác định khi tạo kênh '{name}': {e}")
+                return True
+            except discord.Forbidden:
+                logger.warning(f"Lỗi quyền: Không thể tạo kênh '{name}' trong server {guild.name}")
+            except Exception as e:
+                logger.warning(f"Lỗi không xác định khi tạo kênh '{name}': {e}")
+            return False
+
+        results = await asyncio.gather(
+            *(create_one(guild, name) for guild in self.selected_guilds for name in channel_names)
+        )
+        total_success = sum(results)
+        total_fail = len(results) - total_success
         
         await interaction.followup.send(f"**Báo cáo hoàn tất:**\n✅ Đã tạo thành công: **{total_success}** kênh.\n❌ Thất bại: **{total_fail}** kênh.")
 
@@ -1063,117 +1744,109 @@ class CreateChannelView(discord.ui.View):
         
         # Chia danh sách server thành các trang, mỗi trang 25 server
         self.guild_pages = [self.all_guilds[i:i + 25] for i in range(0, len(self.all_guilds), 25)]
+        # Dựng sẵn SelectOption cho từng trang, lật trang chỉ cần đổi list
+        self._option_pages = [
+            [discord.SelectOption(label=g.name, value=str(g.id)) for g in chunk]
+            for chunk in self.guild_pages
+        ]
         
         # Theo dõi trạng thái
         self.current_guild_page = 0
         self.selected_guild_ids = set()
+        self._selected_guild_str = set()
 
-        # Dựng giao diện ban đầu
-        self.update_view()
-
-    def update_view(self):
-        """Xóa và dựng lại toàn bộ giao diện dựa trên trạng thái hiện tại."""
-        self.clear_items()
-
-        # --- Menu Chọn Server ---
-        current_options = [
-            discord.SelectOption(
-                label=g.name, 
-                value=str(g.id),
-                # Đánh dấu những server đã được chọn trước đó
-                default=(g.id in self.selected_guild_ids)
-            ) 
-            for g in self.guild_pages[self.current_guild_page]
-        ]
-        
-        placeholder = f"Bước 1: Chọn Server (Trang {self.current_guild_page + 1}/{len(self.guild_pages)})"
-        
-        # min_values=0 cho phép bỏ chọn tất cả trong menu hiện tại
-        guild_select = discord.ui.Select(
-            placeholder=placeholder, 
-            min_values=0, 
-            max_values=len(current_options), 
-            options=current_options, 
-            row=0
-        )
-        
-        async def guild_callback(interaction: discord.Interaction):
-            if interaction.user.id != self.author.id:
-                return await interaction.response.send_message("❌ Bạn không có quyền tương tác!", ephemeral=True)
-            
-            # Xóa các lựa chọn cũ từ trang này để xử lý việc bỏ chọn
-            ids_on_this_page = {int(opt.value) for opt in current_options}
-            self.selected_guild_ids.difference_update(ids_on_this_page)
-            
-            # Thêm các lựa chọn mới từ tương tác
-            for gid in interaction.data["values"]:
-                self.selected_guild_ids.add(int(gid))
-                
-            # Cập nhật lại giao diện để hiển thị đúng các lựa chọn và trạng thái nút
-            self.update_view()
-            await interaction.response.edit_message(view=self)
-            await interaction.followup.send(f"✅ Cập nhật! Đã chọn **{len(self.selected_guild_ids)}** server.", ephemeral=True)
-
-        guild_select.callback = guild_callback
-        self.add_item(guild_select)
+        # --- Menu Chọn Server ---
+        # min_values=0 cho phép bỏ chọn tất cả trong menu hiện tại
+        self.guild_select = discord.ui.Select(min_values=0, row=0)
+        self.guild_select.callback = self.guild_callback
+        self.add_item(self.guild_select)
 
         # --- Nút Điều Hướng Server ---
+        self.prev_button = discord.ui.Button(label="◀️ Trang Trước", style=discord.ButtonStyle.secondary, row=1)
+        self.next_button = discord.ui.Button(label="Trang Tiếp ▶️", style=discord.ButtonStyle.secondary, row=1)
+        self.prev_button.callback = self.prev_callback
+        self.next_button.callback = self.next_callback
         if len(self.guild_pages) > 1:
-            prev_button = discord.ui.Button(label="◀️ Trang Trước", style=discord.ButtonStyle.secondary, row=1, disabled=(self.current_guild_page == 0))
-            next_button = discord.ui.Button(label="Trang Tiếp ▶️", style=discord.ButtonStyle.secondary, row=1, disabled=(self.current_guild_page >= len(self.guild_pages) - 1))
-
-            async def prev_callback(interaction: discord.Interaction):
-                if interaction.user.id != self.author.id: return
-                self.current_guild_page -= 1
-                self.update_view()
-                await interaction.response.edit_message(view=self)
-            
-            async def next_callback(interaction: discord.Interaction):
-                if interaction.user.id != self.author.id: return
-                self.current_guild_page += 1
-                self.update_view()
-                await interaction.response.edit_message(view=self)
-            
-            prev_button.callback = prev_callback
-            next_button.callback = next_callback
-            self.add_item(prev_button)
-            self.add_item(next_button)
-            
+            self.add_item(self.prev_button)
+            self.add_item(self.next_button)
+
         # --- Nút Hành Động Cuối Cùng ---
+        self.proceed_button = discord.ui.Button(style=discord.ButtonStyle.success, row=4)
+        self.proceed_button.callback = self.proceed_callback
+        self.add_item(self.proceed_button)
+
+        # Điền dữ liệu cho giao diện ban đầu
+        self.update_view()
+
+    def update_view(self):
+        """Cập nhật tại chỗ options, placeholder và trạng thái nút theo trạng thái hiện tại."""
+        current_options = self._option_pages[self.current_guild_page]
+        # Đánh dấu những server đã được chọn trước đó
+        for opt in current_options:
+            opt.default = opt.value in self._selected_guild_str
+        self.guild_select.options = current_options
+        self.guild_select.max_values = len(current_options)
+        self.guild_select.placeholder = f"Bước 1: Chọn Server (Trang {self.current_guild_page + 1}/{len(self.guild_pages)})"
+
+        self.prev_button.disabled = (self.current_guild_page == 0)
+        self.next_button.disabled = (self.current_guild_page >= len(self.guild_pages) - 1)
+
         # Label của nút sẽ thay đổi để hiển thị số lượng server đã chọn
-        button_label = f"Bước 2: Chọn Số Lượng Kênh ({len(self.selected_guild_ids)} server)"
-        proceed_button = discord.ui.Button(
-            label=button_label,
-            style=discord.ButtonStyle.success,
-            row=4,
-            # Nút bị vô hiệu hóa nếu chưa chọn server nào
-            disabled=(not self.selected_guild_ids)
-        )
+        self.proceed_button.label = f"Bước 2: Chọn Số Lượng Kênh ({len(self.selected_guild_ids)} server)"
+        # Nút bị vô hiệu hóa nếu chưa chọn server nào
+        self.proceed_button.disabled = not self.selected_guild_ids
+
+    async def guild_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id:
+            return await interaction.response.send_message("❌ Bạn không có quyền tương tác!", ephemeral=True)
         
-        async def proceed_callback(interaction: discord.Interaction):
-            if interaction.user.id != self.author.id:
-                return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
+        # Xóa các lựa chọn cũ từ trang này để xử lý việc bỏ chọn
+        ids_on_this_page = {int(opt.value) for opt in self.guild_select.options}
+        self.selected_guild_ids.difference_update(ids_on_this_page)
+        
+        # Thêm các lựa chọn mới từ tương tác
+        for gid in interaction.data["values"]:
+            self.selected_guild_ids.add(int(gid))
+        self._selected_guild_str = {str(i) for i in self.selected_guild_ids}
             
-            # Vô hiệu hóa giao diện cũ trước khi gửi cái mới
-            for item in self.children:
-                item.disabled = True
-            await interaction.message.edit(view=self)
+        # Cập nhật lại giao diện để hiển thị đúng các lựa chọn và trạng thái nút
+        self.update_view()
+        await interaction.response.edit_message(view=self)
+        await interaction.followup.send(f"✅ Cập nhật! Đã chọn **{len(self.selected_guild_ids)}** server.", ephemeral=True)
 
-            # Lấy các đối tượng guild từ các ID đã chọn
-            selected_guilds = [g for g in self.all_guilds if g.id in self.selected_guild_ids]
+    async def prev_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id: return
+        self.current_guild_page -= 1
+        self.update_view()
+        await interaction.response.edit_message(view=self)
+    
+    async def next_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id: return
+        self.current_guild_page += 1
+        self.update_view()
+        await interaction.response.edit_message(view=self)
 
-            embed = discord.Embed(
-                title="🔢 Chọn Số Lượng Kênh",
-                description=f"Bạn đã chọn **{len(selected_guilds)}** server.\nHãy chọn số lượng kênh muốn tạo trong mỗi server:",
-                color=0x00ff00
-            )
-            
-            # Gửi tin nhắn mới (ephemeral) với các nút chọn số lượng
-            view = QuantityView(selected_guilds, self.author)
-            await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+    async def proceed_callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.author.id:
+            return await interaction.response.send_message("❌ Chỉ người tạo lệnh mới có thể sử dụng!", ephemeral=True)
+        
+        # Vô hiệu hóa giao diện cũ trước khi gửi cái mới
+        for item in self.children:
+            item.disabled = True
+        await interaction.message.edit(view=self)
 
-        proceed_button.callback = proceed_callback
-        self.add_item(proceed_button)
+        # Lấy các đối tượng guild từ các ID đã chọn
+        selected_guilds = [g for g in self.all_guilds if g.id in self.selected_guild_ids]
+
+        embed = discord.Embed(
+            title="🔢 Chọn Số Lượng Kênh",
+            description=f"Bạn đã chọn **{len(selected_guilds)}** server.\nHãy chọn số lượng kênh muốn tạo trong mỗi server:",
+            color=0x00ff00
+        )
+        
+        # Gửi tin nhắn mới (ephemeral) với các nút chọn số lượng
+        view = QuantityView(selected_guilds, self.author)
+        await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
 
 
 @bot.command(name='create', help='(Chủ bot) Tạo nhiều kênh trong nhiều server.')
@@ -1181,7 +1854,7 @@ class CreateChannelView(discord.ui.View):
 async def create(ctx):
     """Mở giao diện tạo kênh hàng loạt."""
     # Sắp xếp server giống như lệnh deploy để có thứ tự nhất quán
-    sorted_guilds = sorted(bot.guilds, key=lambda g: g.me.joined_at)
+    sorted_guilds = get_sorted_guilds()
     
     view = CreateChannelView(ctx.author, sorted_guilds)
     
@@ -1193,6 +1866,27 @@ async def create(ctx):
     await ctx.send(embed=embed, view=view)
 
 # --- Getid ---
+# Chỉ mục tên kênh (lowercase) -> [channel_id] theo từng guild, giữ trong thời gian ngắn
+# để các lần mở lại modal liên tiếp không phải quét lại toàn bộ text_channels
+_CHANNEL_NAME_INDEX = {}
+_CHANNEL_NAME_INDEX_TTL = 60
+
+def get_channel_name_index(guild: discord.Guild):
+    """Lấy (hoặc dựng lại) chỉ mục tên kênh của guild"""
+    entry = _CHANNEL_NAME_INDEX.get(guild.id)
+    now = time.monotonic()
+    if entry and now - entry[0] < _CHANNEL_NAME_INDEX_TTL:
+        return entry[1]
+    by_name = defaultdict(list)
+    for channel in guild.text_channels:
+        by_name[channel.name.lower()].append(channel.id)
+    _CHANNEL_NAME_INDEX[guild.id] = (now, by_name)
+    return by_name
+
+def invalidate_channel_name_index(guild_id: int):
+    """Bỏ chỉ mục tên kênh của guild khi kênh được tạo/xóa/đổi tên"""
+    _CHANNEL_NAME_INDEX.pop(guild_id, None)
+
 class ChannelNameModal(discord.ui.Modal, title="Nhập Tên Kênh Cần Tìm"):
     def __init__(self, selected_guilds: list[discord.Guild]):
         super().__init__()
@@ -1207,15 +1901,11 @@ class ChannelNameModal(discord.ui.Modal, title="Nhập Tên Kênh Cần Tìm"):
     async def on_submit(self, interaction: discord.Interaction):
         await interaction.response.send_message(f"🔎 Đang tìm kiếm các kênh có tên `{self.channel_name.value}`...", ephemeral=True)
         
-        results = {}
         target_name = self.channel_name.value.lower().strip()
 
+        results = {}
         for guild in self.selected_guilds:
-            found_channels = []
-            for channel in guild.text_channels:
-                if channel.name.lower() == target_name:
-                    found_channels.append(channel.id)
-            
+            found_channels = get_channel_name_index(guild).get(target_name)
             if found_channels:
                 results[guild.name] = found_channels
 
@@ -1243,6 +1933,7 @@ class GetChannelIdView(discord.ui.View):
         super().__init__(timeout=300)
         self.author = author
         self.guilds = guilds
+        self.guild_by_id = {g.id: g for g in guilds}
         self.selected_guild_ids = set()
         
         # Chia danh sách server thành các phần nhỏ, mỗi phần tối đa 25
@@ -1256,15 +1947,15 @@ class GetChannelIdView(discord.ui.View):
         options = [discord.SelectOption(label=g.name, value=str(g.id)) for g in guild_chunk]
         placeholder = f"Bước 1: Chọn Server (Trang {page_index + 1}/{total_pages})"
         select = discord.ui.Select(placeholder=placeholder, options=options, min_values=1, max_values=len(options))
+        # Tập ID của menu này chỉ tính một lần khi dựng menu
+        ids_in_this_menu = frozenset(g.id for g in guild_chunk)
         
         async def callback(interaction: discord.Interaction):
             if interaction.user.id != self.author.id: return
 
             # Cập nhật tập hợp các ID đã chọn
-            ids_in_this_menu = {int(opt.value) for opt in select.options}
-            self.selected_guild_ids.difference_update(ids_in_this_menu)
-            for gid in interaction.data["values"]:
-                self.selected_guild_ids.add(int(gid))
+            new_ids = {int(gid) for gid in interaction.data["values"]}
+            self.selected_guild_ids = (self.selected_guild_ids - ids_in_this_menu) | new_ids
 
             await interaction.response.send_message(f"✅ Đã cập nhật lựa chọn server.", ephemeral=True)
         
@@ -1278,21 +1969,50 @@ class GetChannelIdView(discord.ui.View):
             return await interaction.response.send_message("Lỗi: Vui lòng chọn ít nhất một Server từ menu.", ephemeral=True)
         
         # Lấy các đối tượng guild từ các ID đã chọn
-        selected_guilds = [g for g in self.guilds if g.id in self.selected_guild_ids]
+        selected_guilds = [self.guild_by_id[gid] for gid in self.selected_guild_ids if gid in self.guild_by_id]
         
         # Mở Modal để người dùng nhập tên kênh (Dòng này giờ sẽ hoạt động)
         modal = ChannelNameModal(selected_guilds)
         await interaction.response.send_modal(modal)
 
 # --- DISCORD BOT EVENTS ---
+@bot.event
+async def setup_hook():
+    """Hàm này được gọi tự động trước khi bot đăng nhập."""
+    # Test JSONBin connection
+    if JSONBIN_API_KEY:
+        print("🌐 Testing JSONBin.io connection...")
+        try:
+            # Lần đọc này cũng nạp sẵn AGENT_INDEX cho roster/deploy
+            agent_count = await refresh_agent_index()
+            print(f"✅ JSONBin.io connected successfully")
+            if agent_count > 0:
+                print(f"📊 Found {agent_count} existing tokens in JSONBin")
+        except Exception as e:
+            print(f"⚠️ JSONBin.io connection issue: {e}")
+        start_agent_index_refresh()
+    else:
+        print("⚠️ JSONBin.io not configured")
+
+    print("🔧 Đang load các module mở rộng (cogs)...")
+    try:
+        await bot.load_extension('channel_tracker') # Tên file mới không có .py
+        print("✅ Đã load thành công module 'channel_tracker'.")
+    except Exception as e:
+        print(f"❌ Lỗi khi load module 'channel_tracker': {e}")
+
 @bot.event
 async def on_ready():
+    # READY mới có thể thay các đối tượng guild -> sắp lại ở lần dùng tiếp theo
+    invalidate_sorted_guilds()
+    # Cập nhật /health ngay khi bot sẵn sàng, không chờ vòng 30 giây kế tiếp
+    await refresh_health_snapshot()
     print(f'✅ Bot đăng nhập thành công: {bot.user.name}')
     print(f'🔗 Web server: {RENDER_URL}')
     print(f'🔑 Redirect URI: {REDIRECT_URI}')
     
     # Check storage status
-    db_status = "Connected" if get_db_connection() else "Unavailable"
+    db_status = "Connected" if DB_HEALTH else "Unavailable"
     jsonbin_status = "Connected" if JSONBIN_API_KEY else "Not configured"
     print(f'💾 Database: {db_status}')
     print(f'🌐 JSONBin.io: {jsonbin_status}')
@@ -1307,12 +2027,40 @@ async def on_ready():
 
 @bot.event
 async def on_message(message):
+    # Tracker ghi nhận mọi tin nhắn (kể cả của bot) như listener cũ
+    tracker = bot.get_cog('ChannelTracker')
+    if tracker is not None:
+        tracker.touch(message.channel.id, message.created_at)
+
     if message.author == bot.user:
         return
     
     # Xử lý các lệnh !command
     await bot.process_commands(message)
 
+@bot.event
+async def on_guild_join(guild):
+    invalidate_sorted_guilds()
+
+@bot.event
+async def on_guild_remove(guild):
+    invalidate_sorted_guilds()
+    invalidate_channel_name_index(guild.id)
+
+# Chỉ mục tên kênh của !getid phải theo kịp các thay đổi kênh (ví dụ ngay sau !create)
+@bot.event
+async def on_guild_channel_create(channel):
+    invalidate_channel_name_index(channel.guild.id)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    invalidate_channel_name_index(channel.guild.id)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    if before.name != after.name:
+        invalidate_channel_name_index(after.guild.id)
+
 @bot.event
 async def on_message_edit(before, after):
     """Xử lý khi tin nhắn được CHỈNH SỬA."""
@@ -1327,16 +2075,12 @@ async def ping(ctx):
 
 @bot.command(name='auth', help='Lấy link ủy quyền để bot có thể thêm bạn vào server.')
 async def auth(ctx):
-    auth_url = (
-        f'https://discord.com/api/oauth2/authorize?client_id={CLIENT_ID}'
-        f'&redirect_uri={REDIRECT_URI}&response_type=code&scope=identify%20guilds.join'
-    )
     embed = discord.Embed(
         title="🔐 Ủy quyền cho Bot",
         description=f"Nhấp vào link bên dưới để cho phép bot thêm bạn vào các server:",
         color=0x00ff00
     )
-    embed.add_field(name="🔗 Link ủy quyền", value=f"[Nhấp vào đây]({auth_url})", inline=False)
+    embed.add_field(name="🔗 Link ủy quyền", value=f"[Nhấp vào đây]({AUTH_URL})", inline=False)
     embed.add_field(name="📌 Lưu ý", value="Token sẽ được lưu an toàn vào cloud storage", inline=False)
     await ctx.send(embed=embed)
 
@@ -1345,7 +2089,7 @@ async def add_me(ctx):
     user_id = ctx.author.id
     await ctx.send(f"✅ Bắt đầu quá trình thêm {ctx.author.mention} vào các server...")
     
-    access_token = get_user_access_token(user_id)
+    access_token = await get_user_access_token(user_id)
     if not access_token:
         embed = discord.Embed(
             title="❌ Chưa ủy quyền",
@@ -1355,29 +2099,7 @@ async def add_me(ctx):
         await ctx.send(embed=embed)
         return
     
-    success_count = 0
-    fail_count = 0
-    
-    for guild in bot.guilds:
-        try:
-            member = guild.get_member(user_id)
-            if member:
-                print(f"👍 {ctx.author.name} đã có trong server {guild.name}")
-                success_count += 1
-                continue
-            
-            success, message = await add_member_to_guild(guild.id, user_id, access_token)
-            
-            if success:
-                print(f"👍 Thêm thành công {ctx.author.name} vào server {guild.name}: {message}")
-                success_count += 1
-            else:
-                print(f"👎 Lỗi khi thêm vào {guild.name}: {message}")
-                fail_count += 1
-                
-        except Exception as e:
-            print(f"👎 Lỗi không xác định khi thêm vào {guild.name}: {e}")
-            fail_count += 1
+    success_count, fail_count = await _fanout_add(ctx.author, bot.guilds, access_token)
     
     embed = discord.Embed(title="📊 Kết quả", color=0x00ff00)
     embed.add_field(name="✅ Thành công", value=f"{success_count} server", inline=True)
@@ -1387,7 +2109,7 @@ async def add_me(ctx):
 @bot.command(name='check_token', help='Kiểm tra xem bạn đã ủy quyền chưa.')
 async def check_token(ctx):
     user_id = ctx.author.id
-    token = get_user_access_token(user_id)
+    token = await get_user_access_token(user_id)
     
     if token:
         embed = discord.Embed(
@@ -1408,10 +2130,7 @@ async def check_token(ctx):
 @bot.command(name='status', help='Kiểm tra trạng thái bot và storage.')
 async def status(ctx):
     # Test database connection
-    db_connection = get_db_connection()
-    db_status = "✅ Connected" if db_connection else "❌ Unavailable"
-    if db_connection:
-        db_connection.close()
+    db_status = "✅ Connected" if DB_HEALTH else "❌ Unavailable"
     
     # Test JSONBin connection
     jsonbin_status = "✅ Configured" if JSONBIN_API_KEY else "❌ Not configured"
@@ -1434,7 +2153,7 @@ async def force_add(ctx, user_to_add: discord.User):
     user_id = user_to_add.id
     await ctx.send(f"✅ Đã nhận lệnh! Bắt đầu quá trình thêm {user_to_add.mention} vào các server...")
     
-    access_token = get_user_access_token(user_id)
+    access_token = await get_user_access_token(user_id)
     if not access_token:
         embed = discord.Embed(
             title="❌ Người dùng chưa ủy quyền",
@@ -1444,29 +2163,7 @@ async def force_add(ctx, user_to_add: discord.User):
         await ctx.send(embed=embed)
         return
     
-    success_count = 0
-    fail_count = 0
-    
-    for guild in bot.guilds:
-        try:
-            member = guild.get_member(user_id)
-            if member:
-                print(f"👍 {user_to_add.name} đã có trong server {guild.name}")
-                success_count += 1
-                continue
-            
-            success, message = await add_member_to_guild(guild.id, user_id, access_token)
-            
-            if success:
-                print(f"👍 Thêm thành công {user_to_add.name} vào server {guild.name}: {message}")
-                success_count += 1
-            else:
-                print(f"👎 Lỗi khi thêm vào {guild.name}: {message}")
-                fail_count += 1
-                
-        except Exception as e:
-            print(f"👎 Lỗi không xác định khi thêm vào {guild.name}: {e}")
-            fail_count += 1
+    success_count, fail_count = await _fanout_add(user_to_add, bot.guilds, access_token)
     
     embed = discord.Embed(title=f"📊 Kết quả thêm {user_to_add.name}", color=0x00ff00)
     embed.add_field(name="✅ Thành công", value=f"{success_count} server", inline=True)
@@ -1506,8 +2203,15 @@ async def invite(ctx, user_to_add: discord.User):
     await ctx.send(embed=embed, view=view)
 
 # --- SLASH COMMANDS ---
-@bot.tree.command(name="help", description="Hiển thị thông tin về các lệnh của bot")
-async def help_slash(interaction: discord.Interaction):
+# Embed trợ giúp được dựng một lần (cần bot.user nên dựng ở lần gọi đầu tiên), key: is_owner
+_HELP_EMBEDS = {}
+
+def get_help_embed(is_owner: bool):
+    """Lấy embed trợ giúp đã dựng sẵn cho người dùng thường hoặc owner"""
+    embed = _HELP_EMBEDS.get(is_owner)
+    if embed is not None:
+        return embed
+
     embed = discord.Embed(
         title="📝 Bảng Lệnh Của Bot Mật Vụ",
         description="Dưới đây là danh sách các mật lệnh có sẵn.",
@@ -1524,7 +2228,7 @@ async def help_slash(interaction: discord.Interaction):
     embed.add_field(name="`!ping`", value="Kiểm tra độ trễ của bot.", inline=True)
     
     # Lệnh chỉ dành cho chủ bot
-    if await bot.is_owner(interaction.user):
+    if is_owner:
         embed.add_field(name="👑 Lệnh Chỉ Huy (Chỉ dành cho Owner)", value="----------------------------------", inline=False)
         embed.add_field(name="`!roster`", value="Xem danh sách điệp viên.", inline=True)
         embed.add_field(name="`!deploy`", value="Thêm NHIỀU điệp viên vào MỘT server.", inline=True)
@@ -1534,37 +2238,17 @@ async def help_slash(interaction: discord.Interaction):
         embed.add_field(name="`!storage_info`", value="Xem thông tin các hệ thống lưu trữ.", inline=True)
 
     embed.set_footer(text="Hãy chọn một mật lệnh để bắt đầu chiến dịch.")
+    _HELP_EMBEDS[is_owner] = embed
+    return embed
+
+@bot.tree.command(name="help", description="Hiển thị thông tin về các lệnh của bot")
+async def help_slash(interaction: discord.Interaction):
+    embed = get_help_embed(interaction.user.id == OWNER_ID)
     await interaction.response.send_message(embed=embed, ephemeral=True)
     
 @bot.command(name='help', help='Hiển thị bảng trợ giúp về các lệnh.')
 async def help(ctx):
-    embed = discord.Embed(
-        title="📝 Bảng Lệnh Của Bot Mật Vụ",
-        description="Dưới đây là danh sách các mật lệnh có sẵn.",
-        color=0x0099ff
-    )
-    embed.set_thumbnail(url=bot.user.display_avatar.url)
-    
-    # Lệnh cho mọi người
-    embed.add_field(name="🕵️ Lệnh Cơ Bản (Dành cho mọi Điệp viên)", value="----------------------------------", inline=False)
-    embed.add_field(name="`!auth`", value="Lấy link ủy quyền để gia nhập mạng lưới.", inline=True)
-    embed.add_field(name="`!add_me`", value="Tự triển khai bản thân đến tất cả server.", inline=True)
-    embed.add_field(name="`!check_token`", value="Kiểm tra trạng thái ủy quyền của bạn.", inline=True)
-    embed.add_field(name="`!status`", value="Xem trạng thái hoạt động của bot và hệ thống.", inline=True)
-    embed.add_field(name="`!ping`", value="Kiểm tra độ trễ của bot.", inline=True)
-
-    # Lệnh chỉ dành cho chủ bot
-    if await bot.is_owner(ctx.author):
-        embed.add_field(name="👑 Lệnh Chỉ Huy (Chỉ dành cho Owner)", value="----------------------------------", inline=False)
-        embed.add_field(name="`!roster`", value="Xem danh sách điệp viên.", inline=True)
-        embed.add_field(name="`!deploy`", value="Thêm NHIỀU điệp viên vào MỘT server.", inline=True)
-        embed.add_field(name="`!invite <User>`", value="Thêm MỘT điệp viên vào NHIỀU server.", inline=True)
-        embed.add_field(name="`!remove <User>`", value="Xóa dữ liệu của một điệp viên.", inline=True)
-        embed.add_field(name="`!force_add <User>`", value="Ép thêm điệp viên vào TẤT CẢ server.", inline=True)
-        embed.add_field(name="`!storage_info`", value="Xem thông tin các hệ thống lưu trữ.", inline=True)
-
-    embed.set_footer(text="Hãy chọn một mật lệnh để bắt đầu chiến dịch.")
-    await ctx.send(embed=embed)
+    await ctx.send(embed=get_help_embed(ctx.author.id == OWNER_ID))
 
 # --- ADDITIONAL JSONBIN MANAGEMENT COMMANDS ---
 @bot.command(name='storage_info', help='(Chủ bot) Hiển thị thông tin về storage systems.')
@@ -1573,40 +2257,45 @@ async def storage_info(ctx):
     """Hiển thị thông tin chi tiết về các storage systems"""
     
     # Test Database
-    db_connection = get_db_connection()
-    if db_connection:
-        try:
-            cursor = db_connection.cursor()
-            cursor.execute("SELECT COUNT(*) FROM user_tokens")
-            db_count = cursor.fetchone()[0]
-            cursor.close()
-            db_connection.close()
-            db_info = f"✅ Connected ({db_count} tokens)"
-        except:
-            db_info = "❌ Connection Error"
-    else:
-        db_info = "❌ Not Available"
-    
-    # Test JSONBin
+    def probe_db_info():
+        with db_connection() as conn:
+            if conn:
+                try:
+                    cursor = conn.cursor()
+                    # Ước lượng từ thống kê planner thay vì quét cả bảng bằng COUNT(*)
+                    cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = 'user_tokens'")
+                    row = cursor.fetchone()
+                    db_count = row[0] if row else -1
+                    if db_count < 0:
+                        # Bảng chưa được ANALYZE lần nào -> chưa có ước lượng, đếm chính xác
+                        cursor.execute("SELECT COUNT(*) FROM user_tokens")
+                        db_count = cursor.fetchone()[0]
+                        cursor.close()
+                        return f"✅ Connected ({db_count} tokens)"
+                    cursor.close()
+                    return f"✅ Connected (~{db_count} tokens)"
+                except:
+                    return "❌ Connection Error"
+            return "❌ Not Available"
+    
+    # JSONBin: đếm từ AGENT_INDEX trong bộ nhớ, không tải lại bin
     if JSONBIN_API_KEY and JSONBIN_BIN_ID:
-        try:
-            data = jsonbin_storage.read_data()
-            jsonbin_count = len(data) if isinstance(data, dict) else 0
-            jsonbin_info = f"✅ Connected ({jsonbin_count} tokens)"
-        except:
-            jsonbin_info = "❌ Connection Error"
+        jsonbin_info = f"✅ Connected ({len(AGENT_INDEX)} tokens)"
     else:
         jsonbin_info = "❌ Not Configured"
+
+    db_info = await asyncio.to_thread(probe_db_info)
     
-    embed = discord.Embed(title="💾 Storage Systems Info", color=0x0099ff)
-    embed.add_field(name="🗃️ PostgreSQL Database", value=db_info, inline=False)
-    embed.add_field(name="🌐 JSONBin.io", value=jsonbin_info, inline=False)
-    
+    # Dựng embed từ dict trong một lần thay vì gọi add_field từng trường
+    fields = [
+        {'name': "🗃️ PostgreSQL Database", 'value': db_info, 'inline': False},
+        {'name': "🌐 JSONBin.io", 'value': jsonbin_info, 'inline': False},
+    ]
     if JSONBIN_BIN_ID:
-        embed.add_field(name="📋 JSONBin Bin ID", value=f"`{JSONBIN_BIN_ID}`", inline=False)
-    
-    embed.add_field(name="ℹ️ Hierarchy", value="Database → JSONBin.io → Local JSON", inline=False)
-    
+        fields.append({'name': "📋 JSONBin Bin ID", 'value': f"`{JSONBIN_BIN_ID}`", 'inline': False})
+    fields.append({'name': "ℹ️ Hierarchy", 'value': "Database → JSONBin.io → Local JSON", 'inline': False})
+
+    embed = discord.Embed.from_dict({'title': "💾 Storage Systems Info", 'color': 0x0099ff, 'fields': fields})
     await ctx.send(embed=embed)
 
 @bot.command(name='migrate_tokens', help='(Chủ bot) Migrate tokens between storage systems.')
@@ -1637,77 +2326,65 @@ async def migrate_tokens(ctx, source: str = None, target: str = None):
         await ctx.send(embed=embed)
         return
     
-    await ctx.send(f"🔄 Starting migration from {source} to {target}...")
+    # Một tin nhắn duy nhất: gửi lúc bắt đầu rồi sửa thành kết quả/lỗi
+    status_msg = await ctx.send(f"🔄 Starting migration from {source} to {target}...")
     
     # Get source data
     source_data = {}
     if source == "db":
-        conn = get_db_connection()
-        if conn:
-            try:
-                cursor = conn.cursor()
-                cursor.execute("SELECT user_id, access_token, username FROM user_tokens")
-                rows = cursor.fetchall()
-                for row in rows:
-                    source_data[row[0]] = {
-                        'access_token': row[1],
-                        'username': row[2],
-                        'updated_at': str(time.time())
-                    }
-                cursor.close()
-                conn.close()
-            except Exception as e:
-                await ctx.send(f"❌ Database read error: {e}")
-                return
+        try:
+            source_data = await asyncio.to_thread(load_all_tokens_db)
+        except Exception as e:
+            await status_msg.edit(content=f"❌ Database read error: {e}")
+            return
     elif source == "jsonbin":
         try:
-            source_data = jsonbin_storage.read_data()
+            # Migration cần bản mới nhất trên JSONBin, không dùng cache
+            jsonbin_storage.invalidate()
+            source_data = await jsonbin_storage.read_data()
         except Exception as e:
-            await ctx.send(f"❌ JSONBin read error: {e}")
+            await status_msg.edit(content=f"❌ JSONBin read error: {e}")
             return
     elif source == "json":
         try:
-            with open('tokens.json', 'r') as f:
-                source_data = json.load(f)
+            source_data = dict(_load_tokens_json())
         except Exception as e:
-            await ctx.send(f"❌ JSON file read error: {e}")
+            await status_msg.edit(content=f"❌ JSON file read error: {e}")
             return
     
+    # Thứ tự roster là metadata của JSONBin, không phải token
+    source_data.pop('_roster_order', None)
     if not source_data:
-        await ctx.send(f"❌ No data found in {source}")
+        await status_msg.edit(content=f"❌ No data found in {source}")
         return
     
-    # Write to target
+    # Gom toàn bộ dữ liệu rồi ghi một lần cho mỗi đích (mọi nguồn đã ở dạng dict chuẩn)
+    items = [
+        (user_id, token_data['access_token'], token_data.get('username'), token_data.get('avatar_hash'))
+        for user_id, token_data in source_data.items() if token_data.get('access_token')
+    ]
+
     success_count = 0
-    fail_count = 0
-    
-    for user_id, token_data in source_data.items():
-        if isinstance(token_data, dict):
-            access_token = token_data.get('access_token')
-            username = token_data.get('username')
-        else:
-            access_token = token_data
-            username = None
-        
-        success = False
+    if items:
         if target == "db":
-            success = save_user_token_db(user_id, access_token, username)
+            success_count = await asyncio.to_thread(save_user_tokens_bulk_db, items)
         elif target == "jsonbin":
-            success = jsonbin_storage.save_user_token(user_id, access_token, username)
+            success_count = await jsonbin_storage.save_user_tokens_bulk(items)
         elif target == "json":
-            success = save_user_token_json(user_id, access_token, username)
-        
-        if success:
-            success_count += 1
-        else:
-            fail_count += 1
-    
-    embed = discord.Embed(title="📦 Migration Complete", color=0x00ff00)
-    embed.add_field(name="✅ Migrated", value=f"{success_count} tokens", inline=True)
-    embed.add_field(name="❌ Failed", value=f"{fail_count} tokens", inline=True)
-    embed.add_field(name="📊 Total", value=f"{len(source_data)} tokens found", inline=True)
+            success_count = save_user_tokens_bulk_json(items)
+    fail_count = len(source_data) - success_count
+    
+    embed = discord.Embed.from_dict({
+        'title': "📦 Migration Complete",
+        'color': 0x00ff00,
+        'fields': [
+            {'name': "✅ Migrated", 'value': f"{success_count} tokens", 'inline': True},
+            {'name': "❌ Failed", 'value': f"{fail_count} tokens", 'inline': True},
+            {'name': "📊 Total", 'value': f"{len(source_data)} tokens found", 'inline': True},
+        ]
+    })
     
-    await ctx.send(embed=embed)
+    await status_msg.edit(content=None, embed=embed)
 
 @bot.command(name='roster', help='(Owner only) Displays a paginated visual roster of all agents.')
 @commands.is_owner()
@@ -1716,53 +2393,31 @@ async def roster(ctx):
     await ctx.send("Đang truy cập kho lưu trữ mạng...")
 
     try:
-        full_data = jsonbin_storage.read_data()
-        if not full_data:
+        # Đọc từ AGENT_INDEX trong bộ nhớ thay vì tải lại toàn bộ JSONBin
+        if not AGENT_INDEX:
             await ctx.send("❌ **Lỗi:** Không tìm thấy hồ sơ điệp viên nào trong mạng.")
             return
 
-        # Tách danh sách thứ tự và dữ liệu điệp viên
-        roster_order = full_data.pop('_roster_order', None)
-        agent_data = full_data
-        
         # --- Logic sắp xếp mới ---
         agents = []
-        
-        # Tạo một set chứa ID của các điệp viên có dữ liệu để kiểm tra nhanh
-        valid_agent_ids = {uid for uid, data in agent_data.items() if isinstance(data, dict)}
 
-        if roster_order:
+        if AGENT_ROSTER_ORDER:
             # 1. Thêm các điệp viên theo thứ tự đã lưu
             ordered_ids = set()
-            for uid in roster_order:
-                if uid in valid_agent_ids:
-                    data = agent_data[uid]
-                    agents.append({
-                        'id': uid, 
-                        'username': data.get('username', 'N/A'), 
-                        'avatar_hash': data.get('avatar_hash')
-                    })
+            for uid in AGENT_ROSTER_ORDER:
+                data = AGENT_INDEX.get(uid)
+                if data is not None and uid not in ordered_ids:
+                    agents.append({'id': uid, **data})
                     ordered_ids.add(uid)
             
             # 2. Thêm các điệp viên mới (chưa có trong danh sách thứ tự) vào cuối
-            for uid in valid_agent_ids:
+            for uid, data in AGENT_INDEX.items():
                 if uid not in ordered_ids:
-                    data = agent_data[uid]
-                    agents.append({
-                        'id': uid, 
-                        'username': data.get('username', 'N/A'), 
-                        'avatar_hash': data.get('avatar_hash')
-                    })
+                    agents.append({'id': uid, **data})
         else:
             # Nếu không có thứ tự, tạo danh sách theo mặc định
             print("⚠️ Không tìm thấy `_roster_order`. Tạo danh sách mặc định.")
-            for uid, data in agent_data.items():
-                if isinstance(data, dict):
-                    agents.append({
-                        'id': uid, 
-                        'username': data.get('username', 'N/A'), 
-                        'avatar_hash': data.get('avatar_hash')
-                    })
+            agents = [{'id': uid, **data} for uid, data in AGENT_INDEX.items()]
 
         if not agents:
             await ctx.send("❌ **Lỗi:** Không tìm thấy dữ liệu điệp viên hợp lệ.")
@@ -1784,13 +2439,14 @@ async def roster_move(ctx, user_to_move: discord.User, position: int):
     Vị trí bắt đầu từ 1.
     Cách dùng: !roster_move @TênNgườiDùng 1
     """
+    global AGENT_ROSTER_ORDER
     if position < 1:
         return await ctx.send("❌ Vị trí phải là một số lớn hơn hoặc bằng 1.")
 
     await ctx.send(f"⏳ Đang thực hiện thay đổi vị trí cho **{user_to_move.name}**...")
 
     # 1. Đọc toàn bộ dữ liệu từ JSONBin
-    full_data = jsonbin_storage.read_data()
+    full_data = await jsonbin_storage.read_data()
     if not full_data:
         return await ctx.send("❌ Không có dữ liệu nào trong storage để sắp xếp.")
 
@@ -1817,10 +2473,9 @@ async def roster_move(ctx, user_to_move: discord.User, position: int):
         # Lỗi này không nên xảy ra do đã kiểm tra ở trên, nhưng vẫn để phòng hờ
         return await ctx.send(f"❌ Không tìm thấy điệp viên **{user_to_move.name}** trong danh sách thứ tự.")
     
-    # 5. Cập nhật lại dữ liệu và ghi vào JSONBin
-    full_data['_roster_order'] = roster_order
-    
-    if jsonbin_storage.write_data(full_data):
+    # 5. Ghi thứ tự mới qua cache của JSONBin (bản full_data có thể đã cũ nếu có token mới được lưu)
+    if await jsonbin_storage.save_roster_order(roster_order):
+        AGENT_ROSTER_ORDER = roster_order
         embed = discord.Embed(
             title="✅ Sắp Xếp Thành Công",
             description=f"Đã di chuyển điệp viên **{user_to_move.name}** đến vị trí **#{position}** trong roster.",
@@ -1854,8 +2509,14 @@ async def remove(ctx, user_to_remove: discord.User):
     await ctx.send(f"🔥 Initiating data purge for agent **{user_to_remove.name}** (`{user_id_str}`)...")
 
     # Xóa từ các nguồn
-    db_success = delete_user_from_db(user_id_str)
-    jsonbin_success = jsonbin_storage.delete_user(user_id_str)
+    invalidate_token_cache(user_id_str)
+    unindex_agent(user_id_str)
+    # Ba nguồn độc lập -> xóa song song. DB gom các lệnh !remove liên tiếp thành một câu DELETE,
+    # JSONBin và tokens.json chỉ sửa bộ nhớ rồi ghi trễ nên nhiều lần xóa cũng chỉ ghi một lần
+    db_success, jsonbin_success = await asyncio.gather(
+        queue_db_delete(user_id_str),
+        jsonbin_storage.delete_user(user_id_str)
+    )
     json_success = delete_user_from_json(user_id_str)
 
     # Tạo báo cáo kết quả
@@ -1873,16 +2534,15 @@ async def remove(ctx, user_to_remove: discord.User):
 @commands.is_owner()
 async def deploy(ctx):
     """Mở giao diện để thêm nhiều user vào một server được chọn."""
-    agent_data = jsonbin_storage.read_data()
     agents = [
-        {'id': uid, 'username': data.get('username', 'N/A')}
-        for uid, data in agent_data.items() if isinstance(data, dict)
+        {'id': uid, 'username': data['username']}
+        for uid, data in AGENT_INDEX.items()
     ]
 
     if not agents:
         return await ctx.send("Không có điệp viên nào trong mạng lưới để triển khai.")
 
-    guilds = sorted(bot.guilds, key=lambda g: g.me.joined_at)
+    guilds = get_sorted_guilds()
     
     view = DeployView(ctx.author, guilds, agents)
     
@@ -1900,7 +2560,7 @@ async def deploy(ctx):
 async def getid(ctx):
     """Mở giao diện để tìm ID kênh."""
     # Sắp xếp danh sách server theo ngày bot tham gia (từ cũ nhất -> mới nhất)
-    sorted_guilds = sorted(bot.guilds, key=lambda g: g.me.joined_at)
+    sorted_guilds = get_sorted_guilds()
     
     # Truyền danh sách đã sắp xếp vào View
     view = GetChannelIdView(ctx.author, sorted_guilds)
@@ -2034,26 +2694,33 @@ async def setupadmin_error(ctx, error):
         await ctx.send(f"Đã xảy ra lỗi không xác định: {error}")
         print(f"Lỗi lệnh setupadmin: {error}")
         
-# --- FLASK WEB ROUTES ---
-@app.route('/')
-def index():
-    auth_url = (
-        f'https://discord.com/api/oauth2/authorize?client_id={CLIENT_ID}'
-        f'&redirect_uri={REDIRECT_URI}&response_type=code&scope=identify%20guilds.join'
-    )
-    
-    # Storage status for display
-    db_status = "🟢 Connected" if get_db_connection() else "🔴 Unavailable"
-    jsonbin_status = "🟢 Configured" if JSONBIN_API_KEY else "🔴 Not configured"
-    
-    return f'''
+# --- WEB ROUTES ---
+_CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+_CSS_PUNCT_RE = re.compile(r'\s*([{};,])\s*')
+_CSS_SPACE_RE = re.compile(r'\s+')
+_STYLE_BLOCK_RE = re.compile(r'(<style>)(.*?)(</style>)', re.S)
+
+def _minify_css(css: str) -> str:
+    """Bỏ comment và khoảng trắng thừa trong CSS (chạy một lần lúc import)"""
+    css = _CSS_COMMENT_RE.sub('', css)
+    css = _CSS_SPACE_RE.sub(' ', css)
+    return _CSS_PUNCT_RE.sub(r'\1', css).strip()
+
+def _minify_style_blocks(page: str) -> str:
+    """Rút gọn mọi khối <style> trong template HTML"""
+    return _STYLE_BLOCK_RE.sub(lambda m: m.group(1) + _minify_css(m.group(2)) + m.group(3), page)
+
+# Trang chủ: template dựng một lần khi import, chỉ còn một chỗ thay thế (auth_url).
+# Ngoặc nhọn trong CSS đã được nhân đôi nên dùng thẳng với str.format
+_INDEX_TEMPLATE = '''
     <!DOCTYPE html>
     <html>
     <head>
         <title>Discord Detective Bureau - Authorization Portal</title>
+        <link rel="preconnect" href="https://fonts.googleapis.com">
+        <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
+        <link rel="stylesheet" href="https://fonts.googleapis.com/css2?family=Creepster&family=UnifrakturMaguntia&family=Griffy:wght@400&family=Nosifer&display=swap">
         <style>
-            @import url('https://fonts.googleapis.com/css2?family=Creepster&family=UnifrakturMaguntia&family=Griffy:wght@400&family=Nosifer&display=swap');
-            
             :root {{
                 --dark-fog: #1a1a1a;
                 --deep-shadow: #0d0d0d;
@@ -2456,11 +3123,11 @@ def index():
                 <div class="status-grid">
                     <div class="status-item">
                         <div class="status-label">🗃️ Evidence Vault</div>
-                        <div>{db_status}</div>
+                        <div id="db-status">⏳ Checking...</div>
                     </div>
                     <div class="status-item">
                         <div class="status-label">🌐 Shadow Network</div>
-                        <div>{jsonbin_status}</div>
+                        <div id="jsonbin-status">⏳ Checking...</div>
                     </div>
                 </div>
                 
@@ -2518,67 +3185,100 @@ def index():
                 </small>
             </div>
         </div>
+        <script>
+            // Trang tĩnh, trạng thái storage lấy riêng qua /status.json
+            fetch('/status.json').then(function (r) {{ return r.json(); }}).then(function (s) {{
+                document.getElementById('db-status').textContent = s.db ? '🟢 Connected' : '🔴 Unavailable';
+                document.getElementById('jsonbin-status').textContent = s.jsonbin ? '🟢 Configured' : '🔴 Not configured';
+            }});
+        </script>
     </body>
     </html>
     '''
+_INDEX_TEMPLATE = _minify_style_blocks(_INDEX_TEMPLATE)
+# Trang chủ là tĩnh: render và nén gzip một lần lúc khởi động, trạng thái lấy qua /status.json
+_INDEX_HTML = _INDEX_TEMPLATE.format(auth_url=AUTH_URL).encode('utf-8')
+_INDEX_HTML_GZ = gzip.compress(_INDEX_HTML, compresslevel=9)
+# ETag mạnh phải khớp từng byte -> mỗi cách mã hóa một tag riêng
+_INDEX_ETAG = f'"{hashlib.blake2b(_INDEX_HTML, digest_size=8).hexdigest()}"'
+_INDEX_ETAG_GZ = f'"{hashlib.blake2b(_INDEX_HTML_GZ, digest_size=8).hexdigest()}-gz"'
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Accept-Encoding có nhận gzip không (bỏ qua 'gzip;q=0')"""
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        if coding.strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        params = params.strip().lower()
+        if params.startswith('q='):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
 
-@app.route('/callback')
-def callback():
-    code = request.args.get('code')
-    if not code:
-        return "❌ Error: Authorization code not received from Discord.", 400
-
-    token_url = 'https://discord.com/api/v10/oauth2/token'
-    payload = {
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET,
-        'grant_type': 'authorization_code',
-        'code': code,
-        'redirect_uri': REDIRECT_URI,
-    }
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-
-    token_response = requests.post(token_url, data=payload, headers=headers)
-    if token_response.status_code != 200:
-        return f"❌ Lỗi khi lấy token: {token_response.text}", 500
-    
-    token_data = token_response.json()
+@routes.get('/')
+async def index(request: web.Request):
+    if _accepts_gzip(request.headers.get('Accept-Encoding', '')):
+        body, etag = _INDEX_HTML_GZ, _INDEX_ETAG_GZ
+    else:
+        body, etag = _INDEX_HTML, _INDEX_ETAG
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if etag in (t.strip() for t in request.headers.get('If-None-Match', '').split(',')):
+        return web.Response(status=304, headers=headers)
+    if body is _INDEX_HTML_GZ:
+        headers['Content-Encoding'] = 'gzip'
+    return web.Response(body=body, content_type='text/html', charset='utf-8', headers=headers)
+
+@routes.get('/status.json')
+async def status_json(request: web.Request):
+    """Trạng thái storage cho trang chủ (đọc cờ DB_HEALTH, không truy vấn DB)"""
+    return web.Response(body=json_dumps({'db': DB_HEALTH, 'jsonbin': bool(JSONBIN_API_KEY)}), content_type='application/json')
+
+OAUTH_TOKEN_URL = 'https://discord.com/api/v10/oauth2/token'
+OAUTH_USER_INFO_URL = 'https://discord.com/api/v10/users/@me'
+_OAUTH_TIMEOUT = aiohttp.ClientTimeout(total=10)
+# Phần cố định của form đổi token, mỗi lần gọi chỉ thêm 'code'
+_OAUTH_BASE_PAYLOAD = {
+    'client_id': CLIENT_ID,
+    'client_secret': CLIENT_SECRET,
+    'grant_type': 'authorization_code',
+    'redirect_uri': REDIRECT_URI,
+}
+
+class OAuthError(Exception):
+    """Discord trả lỗi trong lúc đổi code OAuth2 (message dùng để hiển thị cho user)"""
+
+async def exchange_code(code: str):
+    """Đổi code OAuth2 lấy access token rồi lấy thông tin user qua session aiohttp dùng chung.
+    Trả về (access_token, user_data), ném OAuthError nếu Discord trả lỗi"""
+    session = await get_http_session()
+    payload = {**_OAUTH_BASE_PAYLOAD, 'code': code}
+    async with session.post(OAUTH_TOKEN_URL, data=payload, timeout=_OAUTH_TIMEOUT) as token_response:
+        if token_response.status != 200:
+            raise OAuthError(f"❌ Lỗi khi lấy token: {await token_response.text()}")
+        token_data = json_loads(await token_response.read())
     access_token = token_data['access_token']
 
-    user_info_url = 'https://discord.com/api/v10/users/@me'
     headers = {'Authorization': f'Bearer {access_token}'}
-    user_response = requests.get(user_info_url, headers=headers)
-    
-    if user_response.status_code != 200:
-        return "❌ Lỗi: Không thể lấy thông tin người dùng.", 500
-
-    user_data = user_response.json()
-    user_id = user_data['id']
-    username = user_data['username']
-    avatar_hash = user_data.get('avatar')
-    
-    # Lưu token vào các storage systems
-    success = save_user_token(user_id, access_token, username, avatar_hash)
-    
-    # Determine storage info
-    storage_methods = []
-    if get_db_connection():
-        storage_methods.append("Evidence Vault (PostgreSQL)")
-    if JSONBIN_API_KEY:
-        storage_methods.append("Shadow Network (JSONBin.io)")
-    if not storage_methods:
-        storage_methods.append("Local Archive (JSON)")
-    
-    storage_info = " + ".join(storage_methods)
-
-    return f'''
+    async with session.get(OAUTH_USER_INFO_URL, headers=headers, timeout=_OAUTH_TIMEOUT) as user_response:
+        if user_response.status != 200:
+            raise OAuthError("❌ Lỗi: Không thể lấy thông tin người dùng.")
+        user_data = json_loads(await user_response.read())
+    return access_token, user_data
+
+# Trang đăng nhập thành công: template dựng một lần khi import, chỉ thay username/user_id/storage_info.
+# Ngoặc nhọn trong CSS đã được nhân đôi nên dùng thẳng với str.format
+_SUCCESS_TEMPLATE = '''
     <!DOCTYPE html>
     <html>
     <head>
         <title>Mission Accomplished - Detective Bureau</title>
+        <link rel="preconnect" href="https://fonts.googleapis.com">
+        <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
+        <link rel="stylesheet" href="https://fonts.googleapis.com/css2?family=Creepster&family=EB+Garamond:ital,wght@0,400;1,400&family=Nosifer&family=UnifrakturMaguntia&display=swap">
         <style>
-            @import url('https://fonts.googleapis.com/css2?family=Creepster&family=EB+Garamond:ital,wght@0,400;1,400&family=Nosifer&family=UnifrakturMaguntia&display=swap');
-            
             :root {{
                 --dark-fog: #1a1a1a;
                 --deep-shadow: #0d0d0d;
@@ -2961,41 +3661,170 @@ def callback():
     </body>
     </html>
     '''
+_SUCCESS_TEMPLATE = _minify_style_blocks(_SUCCESS_TEMPLATE)
 
-@app.route('/health')
-def health():
-    """Health check endpoint với thông tin chi tiết"""
-    db_connection = get_db_connection()
-    db_status = db_connection is not None
-    if db_connection:
-        db_connection.close()
-    
-    # Test JSONBin connection
-    jsonbin_status = False
-    if JSONBIN_API_KEY and JSONBIN_BIN_ID:
-        try:
-            test_data = jsonbin_storage.read_data()
-            jsonbin_status = True
-        except:
-            jsonbin_status = False
+def _build_storage_info(db_available: bool):
+    storage_methods = []
+    if db_available:
+        storage_methods.append("Evidence Vault (PostgreSQL)")
+    if JSONBIN_API_KEY:
+        storage_methods.append("Shadow Network (JSONBin.io)")
+    if not storage_methods:
+        storage_methods.append("Local Archive (JSON)")
+    return " + ".join(storage_methods)
+
+# Chuỗi storage chỉ phụ thuộc cấu hình và cờ DB_HEALTH -> dựng sẵn cả hai trường hợp
+STORAGE_INFO = {db_available: _build_storage_info(db_available) for db_available in (False, True)}
+
+# Template tách sẵn thành các đoạn bytes tĩnh xen kẽ tên trường -> mỗi lần render chỉ nối bytes
+_SUCCESS_PARTS = tuple(
+    (literal.encode('utf-8'), field)
+    for literal, field, _, _ in string.Formatter().parse(_SUCCESS_TEMPLATE)
+)
+
+def render_success_page(username, user_id, storage_info) -> bytes:
+    """Render trang thành công (bytes UTF-8), escape các trường do user kiểm soát"""
+    values = {
+        'username': html.escape(str(username)).encode('utf-8'),
+        'user_id': html.escape(str(user_id)).encode('utf-8'),
+        'storage_info': html.escape(storage_info).encode('utf-8'),
+    }
+    chunks = []
+    for literal, field in _SUCCESS_PARTS:
+        chunks.append(literal)
+        if field is not None:
+            chunks.append(values[field])
+    return b''.join(chunks)
+
+# ETag của các trang thành công vừa trả, theo code OAuth (code chỉ dùng được một lần nên
+# trình duyệt tải lại trang sẽ nhận 304 thay vì lỗi invalid_grant từ Discord)
+_SUCCESS_ETAGS = OrderedDict()
+_SUCCESS_ETAG_TTL = 600
+_SUCCESS_ETAG_MAX = 256
+
+@routes.get('/callback')
+async def callback(request: web.Request):
+    code = request.query.get('code')
+    if not code:
+        return web.Response(text="❌ Error: Authorization code not received from Discord.", status=400)
+
+    cached = _SUCCESS_ETAGS.get(code)
+    if cached and time.monotonic() < cached[0] and request.headers.get('If-None-Match') == cached[1]:
+        return web.Response(status=304, headers={'ETag': cached[1]})
+
+    try:
+        access_token, user_data = await exchange_code(code)
+    except OAuthError as e:
+        return web.Response(text=str(e), status=500)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return web.Response(text=f"❌ Lỗi kết nối tới Discord: {e}", status=502)
+
+    user_id = user_data['id']
+    username = user_data['username']
+    avatar_hash = user_data.get('avatar')
     
-    return {
+    # Lưu token vào các storage systems
+    try:
+        await save_user_token(user_id, access_token, username, avatar_hash)
+    except Exception as e:
+        print(f"❌ Không thể lưu token cho user {user_id}: {e}")
+    
+    page = render_success_page(username, user_id, STORAGE_INFO[DB_HEALTH])
+    etag = f'"{hashlib.blake2b(page, digest_size=8).hexdigest()}"'
+    _SUCCESS_ETAGS[code] = (time.monotonic() + _SUCCESS_ETAG_TTL, etag)
+    if len(_SUCCESS_ETAGS) > _SUCCESS_ETAG_MAX:
+        _SUCCESS_ETAGS.popitem(last=False)
+    response = web.Response(
+        body=page, content_type='text/html', charset='utf-8',
+        headers={'ETag': etag, 'Cache-Control': 'private, max-age=60'}
+    )
+    # ~15KB chủ yếu là CSS lặp lại -> nén gzip/deflate nếu trình duyệt hỗ trợ
+    response.enable_compression()
+    return response
+
+# Ảnh chụp trạng thái cho /health, làm mới trong db_health_loop (30 giây) thay vì mỗi lần bị ping
+HEALTH_SNAPSHOT = None
+
+async def refresh_health_snapshot():
+    """Dựng lại HEALTH_SNAPSHOT (gán dict mới, không sửa tại chỗ)"""
+    global HEALTH_SNAPSHOT
+    # Chỉ đọc kết quả request JSONBin gần nhất, không tải lại bin mỗi 30 giây
+    jsonbin_status = bool(JSONBIN_API_KEY and JSONBIN_BIN_ID and jsonbin_storage.last_ok)
+
+    ready = bot.is_ready()
+    HEALTH_SNAPSHOT = {
         "status": "ok", 
-        "bot_connected": bot.is_ready(),
+        "bot_connected": ready,
         "storage": {
-            "database_connected": db_status,
+            "database_connected": DB_HEALTH,
             "jsonbin_configured": JSONBIN_API_KEY is not None,
             "jsonbin_working": jsonbin_status,
             "has_psycopg2": HAS_PSYCOPG2
         },
-        "servers": len(bot.guilds) if bot.is_ready() else 0,
-        "users": len(bot.users) if bot.is_ready() else 0
+        "servers": len(bot.guilds) if ready else 0,
+        "users": len(bot.users) if ready else 0
     }
+    return HEALTH_SNAPSHOT
+
+@routes.get('/health')
+async def health(request: web.Request):
+    """Health check endpoint với thông tin chi tiết (trả ảnh chụp gần nhất)"""
+    snapshot = HEALTH_SNAPSHOT or await refresh_health_snapshot()
+    return web.Response(body=json_dumps(snapshot), content_type='application/json')
+
+app.add_routes(routes)
 
-# --- THREADING FUNCTION ---
-def run_flask():
-    """Chạy Flask server"""
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+# --- WEB SERVER LIFECYCLE ---
+async def start_web_server():
+    """Khởi động aiohttp web server trên event loop của bot"""
+    global web_runner
+    if web_runner is not None:
+        return
+    # Tắt access log (mỗi request một lần format log), giữ hàng đợi accept rộng cho các đợt OAuth dồn dập
+    web_runner = web.AppRunner(app, access_log=None)
+    await web_runner.setup()
+    site = web.TCPSite(web_runner, '0.0.0.0', PORT, backlog=256)
+    await site.start()
+    print(f"🌐 Web server started on port {PORT}")
+
+async def stop_web_server():
+    """Dừng web server và giải phóng cổng"""
+    global web_runner
+    if web_runner is not None:
+        await web_runner.cleanup()
+        web_runner = None
+
+async def main():
+    """Mở web server trước rồi mới đăng nhập bot: /callback và /health vẫn phục vụ
+    khi đăng nhập Discord thất bại (token sai, Discord sập)"""
+    # SIGTERM (Render/Docker khi dừng container) -> bot.close() để ghi nốt JSONBin/tokens.json
+    # thay vì bị kill giữa chừng. Windows không hỗ trợ add_signal_handler
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, request_shutdown)
+    except (NotImplementedError, RuntimeError):
+        pass
+    await get_http_session()
+    # Kiểm tra DB một lần trước khi mở web server, sau đó chạy định kỳ
+    await refresh_db_health()
+    start_db_health_check()
+    await start_web_server()
+
+    try:
+        try:
+            print("🤖 Starting Discord bot...")
+            await bot.start(DISCORD_TOKEN)
+        except Exception as e:
+            print(f"❌ Startup error: {e}")
+            print("🔄 Keeping web server alive...")
+            # Chờ tới khi có SIGTERM (request_shutdown tạo _shutdown_task)
+            while _shutdown_task is None:
+                await asyncio.sleep(1)
+    finally:
+        # Kể cả khi Ctrl+C hủy main: chờ bot.close() ghi xong dữ liệu như bot.run vẫn làm
+        if _shutdown_task is not None:
+            await _shutdown_task
+        elif not bot.is_closed():
+            await bot.close()
 
 # --- MAIN EXECUTION ---
 if __name__ == '__main__':
@@ -3005,48 +3834,16 @@ if __name__ == '__main__':
     
     # Initialize database
     database_initialized = init_database()
-    
-    # Test JSONBin connection
-    if JSONBIN_API_KEY:
-        print("🌐 Testing JSONBin.io connection...")
-        try:
-            test_data = jsonbin_storage.read_data()
-            print(f"✅ JSONBin.io connected successfully")
-            if isinstance(test_data, dict) and len(test_data) > 0:
-                print(f"📊 Found {len(test_data)} existing tokens in JSONBin")
-        except Exception as e:
-            print(f"⚠️ JSONBin.io connection issue: {e}")
-    else:
-        print("⚠️ JSONBin.io not configured")
-
-    @bot.event
-    async def setup_hook():
-        """Hàm này được gọi tự động trước khi bot đăng nhập."""
-        print("🔧 Đang load các module mở rộng (cogs)...")
-        try:
-            await bot.load_extension('channel_tracker') # Tên file mới không có .py
-            print("✅ Đã load thành công module 'channel_tracker'.")
-        except Exception as e:
-            print(f"❌ Lỗi khi load module 'channel_tracker': {e}")
 
+    if HAS_UVLOOP:
+        # asyncio.run tạo loop theo policy nên chỉ cần đặt policy trước khi chạy
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        print("✅ uvloop event loop enabled")
+    
     try:
-        # Start Flask server in separate thread
-        flask_thread = threading.Thread(target=run_flask, daemon=True)
-        flask_thread.start()
-        print(f"🌐 Web server started on port {PORT}")
-        
-        # Wait for Flask to start
-        time.sleep(2)
-        
-        # Start Discord bot in main thread
-        print("🤖 Starting Discord bot...")
-        bot.run(DISCORD_TOKEN)
-        
-    except Exception as e:
-        print(f"❌ Startup error: {e}")
-        print("🔄 Keeping web server alive...")
-        while True:
-            time.sleep(60)
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
 
 
 
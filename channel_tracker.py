@@ -3,116 +3,127 @@
 # Phiên bản 4: Sửa lỗi logic, thông báo khi kênh hoạt động trở lại và tiếp tục theo dõi.
 
 import discord
+import asyncio
 from discord.ext import commands, tasks
-import psycopg2
+import asyncpg
 import os
+import time
 from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
 
-# --- Các hàm tương tác với Database (Synchronous) ---
+# --- Các hàm tương tác với Database (asyncpg, dùng chung một pool) ---
 DATABASE_URL = os.getenv('DATABASE_URL')
 
-def db_connect():
-    """Kết nối tới database."""
+class TrackedRow(NamedTuple):
+    """Một dòng của bảng tracked_channels (bản sao trong bộ nhớ)."""
+    channel_id: int
+    guild_id: int
+    user_id: int
+    notification_channel_id: int
+    is_inactive: bool
+
+async def db_create_pool():
+    """Tạo pool kết nối asyncpg dùng chung cho cả cog (None nếu không kết nối được)."""
+    if not DATABASE_URL:
+        print("[Tracker] Chưa cấu hình DATABASE_URL, bỏ qua database.")
+        return None
     try:
-        return psycopg2.connect(DATABASE_URL, sslmode='require')
+        # asyncpg tự prepare và cache câu lệnh theo từng kết nối (mặc định 100 câu, đủ cho các câu SQL cố định của cog)
+        return await asyncpg.create_pool(DATABASE_URL, ssl='require', min_size=2, max_size=10)
     except Exception as e:
         print(f"[Tracker] Lỗi kết nối database: {e}")
         return None
 
-def init_tracker_db():
+async def init_tracker_db(pool):
     """Tạo hoặc cập nhật bảng 'tracked_channels' để có cột trạng thái."""
-    conn = db_connect()
-    if conn:
+    if pool is None:
+        return
+    async with pool.acquire() as conn:
+        # Tạo bảng nếu chưa có, thêm cột is_inactive để theo dõi trạng thái
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS tracked_channels (
+                channel_id BIGINT PRIMARY KEY,
+                guild_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                notification_channel_id BIGINT NOT NULL,
+                added_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+                is_inactive BOOLEAN DEFAULT FALSE NOT NULL
+            );
+        """)
+        # Cố gắng thêm cột is_inactive nếu bảng đã tồn tại từ phiên bản cũ
+        # Lệnh này sẽ không báo lỗi nếu cột đã tồn tại
         try:
-            with conn.cursor() as cur:
-                # Tạo bảng nếu chưa có, thêm cột is_inactive để theo dõi trạng thái
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS tracked_channels (
-                        channel_id BIGINT PRIMARY KEY,
-                        guild_id BIGINT NOT NULL,
-                        user_id BIGINT NOT NULL,
-                        notification_channel_id BIGINT NOT NULL,
-                        added_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
-                        is_inactive BOOLEAN DEFAULT FALSE NOT NULL
-                    );
-                """)
-                # Cố gắng thêm cột is_inactive nếu bảng đã tồn tại từ phiên bản cũ
-                # Lệnh này sẽ không báo lỗi nếu cột đã tồn tại
-                try:
-                    cur.execute("ALTER TABLE tracked_channels ADD COLUMN is_inactive BOOLEAN DEFAULT FALSE NOT NULL;")
-                    print("[Tracker] Nâng cấp thành công: Đã thêm cột 'is_inactive' vào database.")
-                except psycopg2.errors.DuplicateColumn:
-                    # Cột đã tồn tại, bỏ qua
-                    pass
-                conn.commit()
-            print("[Tracker] Bảng 'tracked_channels' trong database đã sẵn sàng.")
-        finally:
-            conn.close()
-
-def db_add_channel(channel_id, guild_id, user_id, notification_channel_id):
+            await conn.execute("ALTER TABLE tracked_channels ADD COLUMN is_inactive BOOLEAN DEFAULT FALSE NOT NULL;")
+            print("[Tracker] Nâng cấp thành công: Đã thêm cột 'is_inactive' vào database.")
+        except asyncpg.exceptions.DuplicateColumnError:
+            # Cột đã tồn tại, bỏ qua
+            pass
+    print("[Tracker] Bảng 'tracked_channels' trong database đã sẵn sàng.")
+
+# Khi thêm hoặc cập nhật, luôn đặt is_inactive = FALSE
+_UPSERT_CHANNEL_SQL = """
+    INSERT INTO tracked_channels (channel_id, guild_id, user_id, notification_channel_id, is_inactive)
+    VALUES ($1, $2, $3, $4, FALSE)
+    ON CONFLICT (channel_id) DO UPDATE SET
+        user_id = EXCLUDED.user_id,
+        notification_channel_id = EXCLUDED.notification_channel_id,
+        is_inactive = FALSE;
+"""
+
+async def db_add_channel(pool, channel_id, guild_id, user_id, notification_channel_id):
     """Thêm một kênh vào database, reset trạng thái về 'đang hoạt động'."""
-    conn = db_connect()
-    if conn:
-        try:
-            with conn.cursor() as cur:
-                # Khi thêm hoặc cập nhật, luôn đặt is_inactive = FALSE
-                cur.execute(
-                    """
-                    INSERT INTO tracked_channels (channel_id, guild_id, user_id, notification_channel_id, is_inactive)
-                    VALUES (%s, %s, %s, %s, FALSE)
-                    ON CONFLICT (channel_id) DO UPDATE SET
-                        user_id = EXCLUDED.user_id,
-                        notification_channel_id = EXCLUDED.notification_channel_id,
-                        is_inactive = FALSE;
-                    """,
-                    (channel_id, guild_id, user_id, notification_channel_id)
-                )
-                conn.commit()
-        finally:
-            conn.close()
-
-def db_remove_channel(channel_id):
+    if pool is None:
+        return
+    await pool.execute(_UPSERT_CHANNEL_SQL, channel_id, guild_id, user_id, notification_channel_id)
+
+async def db_add_channels_bulk(pool, rows):
+    """Thêm nhiều kênh trong một transaction. rows: list (channel_id, guild_id, user_id, notification_channel_id)"""
+    if pool is None or not rows:
+        return
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.executemany(_UPSERT_CHANNEL_SQL, rows)
+
+async def db_remove_channel(pool, channel_id):
     """Xóa một kênh khỏi database."""
-    conn = db_connect()
-    if conn:
-        try:
-            with conn.cursor() as cur:
-                cur.execute("DELETE FROM tracked_channels WHERE channel_id = %s;", (channel_id,))
-                conn.commit()
-        finally:
-            conn.close()
+    if pool is None:
+        return
+    await pool.execute("DELETE FROM tracked_channels WHERE channel_id = $1;", channel_id)
 
-def db_get_all_tracked():
+async def db_get_all_tracked(pool):
     """Lấy danh sách tất cả các kênh đang được theo dõi và trạng thái của chúng."""
-    conn = db_connect()
-    if conn:
-        try:
-            with conn.cursor() as cur:
-                cur.execute("SELECT channel_id, guild_id, user_id, notification_channel_id, is_inactive FROM tracked_channels;")
-                results = cur.fetchall()
-                return results
-        finally:
-            conn.close()
-    return []
-
-def db_update_channel_status(channel_id, is_now_inactive: bool):
-    """Cập nhật trạng thái 'is_inactive' cho một kênh."""
-    conn = db_connect()
-    if conn:
-        try:
-            with conn.cursor() as cur:
-                cur.execute("UPDATE tracked_channels SET is_inactive = %s WHERE channel_id = %s;", (is_now_inactive, channel_id))
-                conn.commit()
-        finally:
-            conn.close()
-
-# Chạy khởi tạo/cập nhật DB một lần khi bot load module này
-init_tracker_db()
+    if pool is None:
+        return []
+    return await pool.fetch("SELECT channel_id, guild_id, user_id, notification_channel_id, is_inactive FROM tracked_channels;")
+
+# Một câu lệnh cố định cho mọi thay đổi trạng thái của lượt kiểm tra -> luôn trúng cache prepared statement
+_SET_STATUS_SQL = """
+    UPDATE tracked_channels AS t SET is_inactive = u.is_inactive
+    FROM unnest($1::bigint[], $2::boolean[]) AS u(channel_id, is_inactive)
+    WHERE t.channel_id = u.channel_id;
+"""
+
+async def db_apply_tick_changes(pool, to_mark_inactive, to_mark_active, to_delete):
+    """Ghi mọi thay đổi của một lượt kiểm tra trong một transaction (một lần commit)."""
+    if pool is None or not (to_mark_inactive or to_mark_active or to_delete):
+        return
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if to_mark_inactive or to_mark_active:
+                ids = to_mark_inactive + to_mark_active
+                flags = [True] * len(to_mark_inactive) + [False] * len(to_mark_active)
+                await conn.execute(_SET_STATUS_SQL, ids, flags)
+            if to_delete:
+                await conn.execute("DELETE FROM tracked_channels WHERE channel_id = ANY($1::bigint[]);", to_delete)
 
 # --- Các thành phần UI (Views, Modals) ---
 
 class TrackByIDModal(discord.ui.Modal, title="Theo dõi bằng ID Kênh"):
     """Modal để người dùng nhập ID của kênh muốn theo dõi."""
+    def __init__(self, tracker: "ChannelTracker"):
+        super().__init__()
+        self.tracker = tracker
+
     channel_id_input = discord.ui.TextInput(
         label="ID của kênh cần theo dõi",
         placeholder="Dán ID của kênh văn bản vào đây...",
@@ -128,12 +139,19 @@ class TrackByIDModal(discord.ui.Modal, title="Theo dõi bằng ID Kênh"):
         except ValueError:
             return await interaction.response.send_message("ID kênh không hợp lệ. Vui lòng chỉ nhập số.", ephemeral=True)
 
+        # Snowflake chứa thời điểm tạo: ID "đến từ tương lai" chắc chắn sai, loại trước khi tra cache kênh
+        if (channel_id >> 22) + discord.utils.DISCORD_EPOCH > int(time.time() * 1000):
+            return await interaction.response.send_message("ID kênh không hợp lệ. Vui lòng kiểm tra lại.", ephemeral=True)
+
         channel_to_track = bot.get_channel(channel_id)
         if not isinstance(channel_to_track, discord.TextChannel):
             return await interaction.response.send_message("Không tìm thấy kênh văn bản với ID này hoặc bot không có quyền truy cập.", ephemeral=True)
         
-        await bot.loop.run_in_executor(
-            None, db_add_channel, channel_to_track.id, channel_to_track.guild.id, interaction.user.id, interaction.channel_id
+        await db_add_channel(
+            self.tracker.pool, channel_to_track.id, channel_to_track.guild.id, interaction.user.id, interaction.channel_id
+        )
+        self.tracker.tracked[channel_to_track.id] = TrackedRow(
+            channel_to_track.id, channel_to_track.guild.id, interaction.user.id, interaction.channel_id, False
         )
 
         embed = discord.Embed(
@@ -147,6 +165,10 @@ class TrackByIDModal(discord.ui.Modal, title="Theo dõi bằng ID Kênh"):
 
 class TrackByNameModal(discord.ui.Modal, title="Theo dõi kênh trên mọi Server"):
     """Modal để người dùng nhập tên kênh và bot sẽ tìm trên tất cả server."""
+    def __init__(self, tracker: "ChannelTracker"):
+        super().__init__()
+        self.tracker = tracker
+
     channel_name_input = discord.ui.TextInput(
         label="Nhập chính xác tên kênh cần theo dõi",
         placeholder="Ví dụ: general, announcements, v.v.",
@@ -158,10 +180,12 @@ class TrackByNameModal(discord.ui.Modal, title="Theo dõi kênh trên mọi Serv
         bot = interaction.client
         channel_name = self.channel_name_input.value.strip().lower().replace('-', ' ')
 
+        # Dùng chung chỉ mục tên kênh theo guild của bot (như !getid), mỗi server lấy kênh đầu tiên
         found_channels = []
         for guild in bot.guilds:
             if guild.get_member(interaction.user.id):
-                target_channel = discord.utils.get(guild.text_channels, name=channel_name)
+                channel_ids = bot.channel_name_index(guild).get(channel_name)
+                target_channel = guild.get_channel(channel_ids[0]) if channel_ids else None
                 if target_channel:
                     found_channels.append(target_channel)
 
@@ -169,10 +193,10 @@ class TrackByNameModal(discord.ui.Modal, title="Theo dõi kênh trên mọi Serv
             await interaction.followup.send(f"Không tìm thấy kênh nào tên `{self.channel_name_input.value}` trong các server bạn có mặt.", ephemeral=True)
             return
 
-        for channel in found_channels:
-            await bot.loop.run_in_executor(
-                None, db_add_channel, channel.id, channel.guild.id, interaction.user.id, interaction.channel_id
-            )
+        rows = [(c.id, c.guild.id, interaction.user.id, interaction.channel_id) for c in found_channels]
+        await db_add_channels_bulk(self.tracker.pool, rows)
+        for row in rows:
+            self.tracker.tracked[row[0]] = TrackedRow(*row, False)
 
         server_list_str = "\n".join([f"• **{c.guild.name}**" for c in found_channels])
         embed = discord.Embed(
@@ -185,10 +209,10 @@ class TrackByNameModal(discord.ui.Modal, title="Theo dõi kênh trên mọi Serv
 
 class TrackInitialView(discord.ui.View):
     """View ban đầu với hai lựa chọn: theo dõi bằng ID hoặc Tên."""
-    def __init__(self, author_id: int, bot: commands.Bot):
+    def __init__(self, author_id: int, tracker: "ChannelTracker"):
         super().__init__(timeout=180)
         self.author_id = author_id
-        self.bot = bot
+        self.tracker = tracker
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         if interaction.user.id != self.author_id:
@@ -198,11 +222,11 @@ class TrackInitialView(discord.ui.View):
 
     @discord.ui.button(label="Theo dõi bằng ID Kênh", style=discord.ButtonStyle.primary, emoji="🆔")
     async def track_by_id(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.send_modal(TrackByIDModal())
+        await interaction.response.send_modal(TrackByIDModal(self.tracker))
 
     @discord.ui.button(label="Theo dõi bằng Tên Kênh", style=discord.ButtonStyle.secondary, emoji="📝")
     async def track_by_name(self, interaction: discord.Interaction, button: discord.ui.Button):
-        await interaction.response.send_modal(TrackByNameModal())
+        await interaction.response.send_modal(TrackByNameModal(self.tracker))
 
 
 # --- Cog chính ---
@@ -210,71 +234,133 @@ class ChannelTracker(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.inactivity_threshold_minutes = int(os.getenv('INACTIVITY_THRESHOLD_MINUTES', 7 * 24 * 60))
+        self.pool = None
+        # Bản sao bảng tracked_channels (channel_id -> TrackedRow), nạp một lần khi load
+        # và được sửa cùng lúc với mỗi lần ghi DB nên không phải SELECT lại cả bảng
+        self.tracked: dict[int, TrackedRow] = {}
+        # Thời điểm hoạt động cuối của từng kênh đang theo dõi (channel_id -> datetime),
+        # cập nhật qua touch() từ on_message của bot nên vòng kiểm tra không cần gọi API Discord
+        self.activity: dict[int, datetime] = {}
+        # Giới hạn số tin nhắn thông báo gửi đồng thời trong một lượt kiểm tra
+        self.send_semaphore = asyncio.Semaphore(10)
+
+    async def cog_load(self):
+        # Tạo pool và khởi tạo/cập nhật DB một lần khi bot load module này
+        self.pool = await db_create_pool()
+        try:
+            await init_tracker_db(self.pool)
+            self.tracked = {row[0]: TrackedRow(*row) for row in await db_get_all_tracked(self.pool)}
+        except Exception as e:
+            print(f"[Tracker] Lỗi khởi tạo database: {e}")
         self.check_activity.start()
 
-    def cog_unload(self):
+    async def cog_unload(self):
         self.check_activity.cancel()
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    def _set_inactive(self, channel_id: int, is_inactive: bool):
+        row = self.tracked.get(channel_id)
+        if row is not None:
+            self.tracked[channel_id] = row._replace(is_inactive=is_inactive)
+
+    def touch(self, channel_id: int, created_at: datetime):
+        """Ghi nhận hoạt động của kênh, gọi từ bộ điều phối on_message của bot"""
+        # Chỉ ghi nhận các kênh đang được theo dõi
+        if channel_id in self.tracked:
+            self.activity[channel_id] = created_at
+
+    async def _send_notification(self, notification_channel, **kwargs):
+        async with self.send_semaphore:
+            await notification_channel.send(**kwargs)
+
+    async def _process_one(self, row: TrackedRow, to_mark_inactive, to_mark_active, to_delete):
+        """Kiểm tra một kênh, ghi thay đổi trạng thái vào các danh sách của lượt hiện tại."""
+        channel_id, guild_id, user_id, notification_channel_id, was_inactive = row
+        notification_channel = self.bot.get_channel(notification_channel_id)
+        if not notification_channel:
+            print(f"[Tracker] LỖI: Không tìm thấy kênh thông báo {notification_channel_id}, xóa kênh {channel_id} khỏi DB.")
+            to_delete.append(channel_id)
+            self.tracked.pop(channel_id, None)
+            self.activity.pop(channel_id, None)
+            return
 
-    @tasks.loop(minutes=30)
-    async def check_activity(self):
-        print(f"[{datetime.now()}] [Tracker] Bắt đầu kiểm tra trạng thái kênh...")
-        
-        tracked_channels_data = await self.bot.loop.run_in_executor(None, db_get_all_tracked)
+        channel_to_track = self.bot.get_channel(channel_id)
+        if not channel_to_track:
+            print(f"[Tracker] Kênh {channel_id} không tồn tại, đang xóa khỏi DB.")
+            to_delete.append(channel_id)
+            self.tracked.pop(channel_id, None)
+            self.activity.pop(channel_id, None)
+            return
         
-        for channel_id, guild_id, user_id, notification_channel_id, was_inactive in tracked_channels_data:
-            notification_channel = self.bot.get_channel(notification_channel_id)
-            if not notification_channel:
-                print(f"[Tracker] LỖI: Không tìm thấy kênh thông báo {notification_channel_id}, xóa kênh {channel_id} khỏi DB.")
-                await self.bot.loop.run_in_executor(None, db_remove_channel, channel_id)
-                continue
-
-            channel_to_track = self.bot.get_channel(channel_id)
-            if not channel_to_track:
-                print(f"[Tracker] Kênh {channel_id} không tồn tại, đang xóa khỏi DB.")
-                await self.bot.loop.run_in_executor(None, db_remove_channel, channel_id)
-                continue
+        try:
+            last_activity_time = self.activity.get(channel_id)
+            if last_activity_time is None:
+                # Lần đầu gặp kênh này (mới khởi động hoặc vừa thêm): ID snowflake của tin nhắn cuối
+                # đã chứa thời điểm tạo -> giải mã tại chỗ, không cần fetch_message
+                mid = channel_to_track.last_message_id
+                last_activity_time = discord.utils.snowflake_time(mid) if mid else channel_to_track.created_at
+                self.activity[channel_id] = last_activity_time
+            time_since_activity = datetime.now(timezone.utc) - last_activity_time
             
-            try:
-                last_message = await channel_to_track.fetch_message(channel_to_track.last_message_id) if channel_to_track.last_message_id else None
-                last_activity_time = last_message.created_at if last_message else channel_to_track.created_at
-                time_since_activity = datetime.now(timezone.utc) - last_activity_time
+            is_currently_inactive = time_since_activity > timedelta(minutes=self.inactivity_threshold_minutes)
+            # Mention chỉ cần ID, không cần fetch_user; tên hiển thị lấy từ cache nếu có
+            mention = f"<@{user_id}>"
+            user_to_notify = self.bot.get_user(user_id)
+
+            # KỊCH BẢN 1: Kênh vừa mới trở nên không hoạt động
+            if is_currently_inactive and not was_inactive:
+                print(f"[Tracker] Kênh {channel_id} đã không hoạt động. Gửi cảnh báo.")
+                to_mark_inactive.append(channel_id)
+                self._set_inactive(channel_id, True)
                 
-                is_currently_inactive = time_since_activity > timedelta(minutes=self.inactivity_threshold_minutes)
-                user_to_notify = self.bot.get_user(user_id) or await self.bot.fetch_user(user_id)
-                mention = user_to_notify.mention if user_to_notify else f"<@{user_id}>"
-
-                # KỊCH BẢN 1: Kênh vừa mới trở nên không hoạt động
-                if is_currently_inactive and not was_inactive:
-                    print(f"[Tracker] Kênh {channel_id} đã không hoạt động. Gửi cảnh báo.")
-                    await self.bot.loop.run_in_executor(None, db_update_channel_status, channel_id, True)
-                    
-                    embed = discord.Embed(
-                        title="⚠️ Cảnh báo Kênh không hoạt động",
-                        description=f"Kênh {channel_to_track.mention} tại **{channel_to_track.guild.name}** đã không có tin nhắn mới trong hơn **{self.inactivity_threshold_minutes}** phút.",
-                        color=discord.Color.orange()
-                    )
-                    embed.add_field(name="Lần hoạt động cuối", value=f"<t:{int(last_activity_time.timestamp())}:R>", inline=False)
-                    embed.set_footer(text=f"Thiết lập bởi {user_to_notify.display_name if user_to_notify else f'User ID: {user_id}'}")
-                    await notification_channel.send(content=f"Thông báo cho {mention}:", embed=embed)
-
-                # KỊCH BẢN 2: Kênh đã hoạt động trở lại
-                elif not is_currently_inactive and was_inactive:
-                    print(f"[Tracker] Kênh {channel_id} đã hoạt động trở lại. Gửi thông báo.")
-                    await self.bot.loop.run_in_executor(None, db_update_channel_status, channel_id, False)
-
-                    embed = discord.Embed(
-                        title="✅ Kênh đã hoạt động trở lại",
-                        description=f"Kênh {channel_to_track.mention} tại **{channel_to_track.guild.name}** đã có hoạt động mới.",
-                        color=discord.Color.green()
-                    )
-                    embed.add_field(name="Hoạt động gần nhất", value=f"<t:{int(last_activity_time.timestamp())}:R>", inline=False)
-                    embed.set_footer(text=f"Bot sẽ tiếp tục theo dõi kênh này.")
-                    await notification_channel.send(content=f"Cập nhật cho {mention}:", embed=embed)
-            
-            except discord.Forbidden:
-                print(f"[Tracker] Lỗi quyền: Không thể đọc lịch sử kênh {channel_to_track.name} ({channel_id}). Bỏ qua.")
-            except Exception as e:
-                print(f"[Tracker] Lỗi không xác định khi kiểm tra kênh {channel_id}: {e}")
+                embed = discord.Embed(
+                    title="⚠️ Cảnh báo Kênh không hoạt động",
+                    description=f"Kênh {channel_to_track.mention} tại **{channel_to_track.guild.name}** đã không có tin nhắn mới trong hơn **{self.inactivity_threshold_minutes}** phút.",
+                    color=discord.Color.orange()
+                )
+                embed.add_field(name="Lần hoạt động cuối", value=f"<t:{int(last_activity_time.timestamp())}:R>", inline=False)
+                embed.set_footer(text=f"Thiết lập bởi {user_to_notify.display_name if user_to_notify else f'User ID: {user_id}'}")
+                await self._send_notification(notification_channel, content=f"Thông báo cho {mention}:", embed=embed)
+
+            # KỊCH BẢN 2: Kênh đã hoạt động trở lại
+            elif not is_currently_inactive and was_inactive:
+                print(f"[Tracker] Kênh {channel_id} đã hoạt động trở lại. Gửi thông báo.")
+                to_mark_active.append(channel_id)
+                self._set_inactive(channel_id, False)
+
+                embed = discord.Embed(
+                    title="✅ Kênh đã hoạt động trở lại",
+                    description=f"Kênh {channel_to_track.mention} tại **{channel_to_track.guild.name}** đã có hoạt động mới.",
+                    color=discord.Color.green()
+                )
+                embed.add_field(name="Hoạt động gần nhất", value=f"<t:{int(last_activity_time.timestamp())}:R>", inline=False)
+                embed.set_footer(text=f"Bot sẽ tiếp tục theo dõi kênh này.")
+                await self._send_notification(notification_channel, content=f"Cập nhật cho {mention}:", embed=embed)
+        
+        except Exception as e:
+            print(f"[Tracker] Lỗi không xác định khi kiểm tra kênh {channel_id}: {e}")
+
+    # Vòng kiểm tra chỉ so sánh thời điểm trong bộ nhớ nên có thể chạy dày hơn 30 phút
+    @tasks.loop(minutes=5)
+    async def check_activity(self):
+        print(f"[{datetime.now()}] [Tracker] Bắt đầu kiểm tra trạng thái kênh...")
+        
+        tracked_channels_data = list(self.tracked.values())
+        # Gom thay đổi trạng thái, ghi một lần ở cuối lượt
+        to_mark_inactive, to_mark_active, to_delete = [], [], []
+
+        # Các kênh độc lập với nhau -> xử lý song song, số lượt gửi tin nhắn bị giới hạn bởi self.send_semaphore
+        await asyncio.gather(
+            *(self._process_one(row, to_mark_inactive, to_mark_active, to_delete) for row in tracked_channels_data),
+            return_exceptions=True
+        )
+
+        try:
+            await db_apply_tick_changes(self.pool, to_mark_inactive, to_mark_active, to_delete)
+        except Exception as e:
+            print(f"[Tracker] Lỗi ghi trạng thái kênh vào database: {e}")
 
     @check_activity.before_loop
     async def before_check_activity(self):
@@ -287,7 +373,7 @@ class ChannelTracker(commands.Cog):
             description="Chọn phương thức bạn muốn dùng để xác định kênh cần theo dõi.",
             color=discord.Color.blue()
         )
-        view = TrackInitialView(author_id=ctx.author.id, bot=self.bot)
+        view = TrackInitialView(author_id=ctx.author.id, tracker=self)
         await ctx.send(embed=embed, view=view)
 
     @commands.command(name='untrack', help='Ngừng theo dõi hoạt động của một kênh.')
@@ -296,19 +382,20 @@ class ChannelTracker(commands.Cog):
             await ctx.send("Vui lòng gắn thẻ kênh bạn muốn ngừng theo dõi. Ví dụ: `!untrack #tên-kênh`", ephemeral=True)
             return
     
-        tracked_channels_data = await self.bot.loop.run_in_executor(None, db_get_all_tracked)
-        tracked_channel = next((tc for tc in tracked_channels_data if tc[0] == channel.id), None)
+        tracked_channel = self.tracked.get(channel.id)
         
         if not tracked_channel:
             await ctx.send(f"Kênh {channel.mention} hiện không được theo dõi.", ephemeral=True)
             return
             
-        user_id_who_added = tracked_channel[2]
+        user_id_who_added = tracked_channel.user_id
         if user_id_who_added != ctx.author.id and not ctx.author.guild_permissions.manage_channels:
             await ctx.send("Bạn không có quyền ngừng theo dõi kênh này.", ephemeral=True)
             return
     
-        await self.bot.loop.run_in_executor(None, db_remove_channel, channel.id)
+        await db_remove_channel(self.pool, channel.id)
+        self.tracked.pop(channel.id, None)
+        self.activity.pop(channel.id, None)
         
         embed = discord.Embed(
             title="✅ Dừng theo dõi", description=f"Đã ngừng theo dõi kênh {channel.mention}.", color=discord.Color.red()
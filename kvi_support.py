@@ -1,110 +1,210 @@
 import discord
 import re
 import os
-import asyncio
 import json
+import time
+import hashlib
+import heapq
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
 from typing import Optional, List, Dict
 import aiohttp
 
+# orjson (tùy chọn) parse/serialize nhanh hơn json chuẩn
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = lambda obj: json.dumps(obj).encode()
+
 # --- CẤU HÌNH ---
 KARUTA_ID = 646937666251915264
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
+# Log chi tiết từng bước ở mức DEBUG (mặc định bị lọc), không ghi stdout trên mỗi tin nhắn Karuta
+log = logging.getLogger(__name__)
+
+# Regex biên dịch sẵn cho parse_karuta_embed (chạy với mọi embed KVI)
+_CHAR_RE = re.compile(r"Character · \*\*([^\*]+)\*\*")
+_QUESTION_RE = re.compile(r'["“]([^"”]+)["”]')
+# Emoji lựa chọn (3 code point: chữ số + U+FE0F + U+20E3) -> số thứ tự, so khớp bằng startswith thay cho regex
+_CHOICE_EMOJIS = (('1️⃣', 1), ('2️⃣', 2), ('3️⃣', 3), ('4️⃣', 4), ('5️⃣', 5))
+
+# Timeout cho mỗi lần gọi Gemini, dùng được cả với session dùng chung lẫn session riêng
+_GEMINI_TIMEOUT = aiohttp.ClientTimeout(total=8)
+
+# Gemini trả JSON thuần theo schema cố định -> không còn bọc ```json cần lọc bỏ
+_GENERATION_CONFIG = {
+    "responseMimeType": "application/json",
+    "responseSchema": {
+        "type": "object",
+        "properties": {
+            "analysis": {"type": "string"},
+            "percentages": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "choice": {"type": "integer"},
+                        "percentage": {"type": "integer"}
+                    },
+                    "required": ["choice", "percentage"]
+                }
+            }
+        },
+        "required": ["analysis", "percentages"]
+    }
+}
+
+# Cache kết quả Gemini theo (nhân vật, câu hỏi, các lựa chọn): câu KVI lặp lại rất nhiều giữa các server
+_AI_CACHE = OrderedDict()  # key -> (hết hạn lúc, kết quả)
+_AI_CACHE_TTL = 6 * 3600
+_AI_CACHE_MAX = 4096
+
+@dataclass(slots=True)
+class Choice:
+    number: int
+    text: str
+
+@dataclass(slots=True)
+class KVIPayload:
+    """Kết quả parse_karuta_embed"""
+    character: str
+    question: str
+    choices: List[Choice]
+
+def _ai_cache_key(character: str, question: str, choices: List[Choice]) -> str:
+    choice_texts = "|".join(c.text for c in sorted(choices, key=lambda c: c.number))
+    return hashlib.sha1(f"{character}|{question}|{choice_texts}".encode()).hexdigest()
+
 class KVIHelper:
-    def __init__(self, bot):
+    __slots__ = ("bot", "api_key", "http_session", "_owns_session")
+
+    def __init__(self, bot, http_session: Optional[aiohttp.ClientSession] = None):
         self.bot = bot
         self.api_key = GEMINI_API_KEY
-        self.http_session = None
+        # Ưu tiên dùng chung session của bot để tái sử dụng kết nối (keep-alive)
+        self.http_session = http_session
+        # True nếu session do KVIHelper tự tạo -> phải tự đóng trong close()
+        self._owns_session = False
         if not self.api_key:
             print("⚠️ [KVI] Cảnh báo: Không tìm thấy GEMINI_API_KEY.")
 
-    async def async_setup(self):
-        """Tạo HTTP session sau khi bot sẵn sàng"""
+    async def async_setup(self, http_session: Optional[aiohttp.ClientSession] = None):
+        """Gắn HTTP session dùng chung (nếu có), chỉ tự tạo session riêng khi cần"""
+        if http_session is not None:
+            self.http_session = http_session
+            self._owns_session = False
         if not self.http_session or self.http_session.closed:
-            self.http_session = aiohttp.ClientSession()
+            # Connector giữ kết nối keep-alive tới Gemini để bỏ bắt tay TLS ở các lần gọi sau
+            connector = aiohttp.TCPConnector(
+                limit=20,
+                limit_per_host=10,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+                enable_cleanup_closed=True
+            )
+            self.http_session = aiohttp.ClientSession(connector=connector, timeout=_GEMINI_TIMEOUT)
+            self._owns_session = True
             print("✅ [KVI] HTTP session đã sẵn sàng.")
 
-    def parse_karuta_embed(self, embed) -> Optional[Dict]:
-        """Phân tích embed của Karuta để lấy thông tin"""
+    async def close(self):
+        """Đóng session riêng (session dùng chung do bot tự đóng)"""
+        if self._owns_session and self.http_session and not self.http_session.closed:
+            await self.http_session.close()
+        self.http_session = None
+        self._owns_session = False
+
+    def parse_karuta_embed(self, embed, description: Optional[str] = None) -> Optional[KVIPayload]:
+        """Phân tích embed của Karuta để lấy thông tin (description truyền sẵn nếu đã lấy)"""
         try:
-            description = embed.description or ""
-            print(f"[DEBUG] parse_karuta_embed: Nội dung embed (500 ký tự đầu):\n{description[:500]}...")
+            if description is None:
+                description = embed.description or ""
+            log.debug("parse_karuta_embed: Nội dung embed (500 ký tự đầu):\n%s...", description[:500])
 
             # Tìm tên nhân vật
-            char_match = re.search(r"Character · \*\*([^\*]+)\*\*", description)
+            char_match = _CHAR_RE.search(description)
             character_name = char_match.group(1).strip() if char_match else None
-            print(f"[DEBUG] parse_karuta_embed: Tên nhân vật = {character_name}")
+            log.debug("parse_karuta_embed: Tên nhân vật = %s", character_name)
 
             # Tìm câu hỏi trong dấu ngoặc kép (hỗ trợ cả " và “ ”)
-            question_match = re.search(r'["“]([^"”]+)["”]', description)
+            question_match = _QUESTION_RE.search(description)
             question = question_match.group(1).strip() if question_match else None
-            print(f"[DEBUG] parse_karuta_embed: Câu hỏi = {question}")
+            log.debug("parse_karuta_embed: Câu hỏi = %s", question)
 
             # Tìm tất cả các dòng bắt đầu bằng emoji 1️⃣-5️⃣
-            choice_lines = re.findall(r'^(1️⃣|2️⃣|3️⃣|4️⃣|5️⃣)\s+(.+)$', description, re.MULTILINE)
-            print(f"[DEBUG] parse_karuta_embed: Số dòng lựa chọn tìm thấy: {len(choice_lines)}")
-
-            # Mapping emoji -> số
-            emoji_to_number = {
-                '1️⃣': 1, '2️⃣': 2, '3️⃣': 3, '4️⃣': 4, '5️⃣': 5
-            }
-
             choices = []
-            for emoji, text in choice_lines:
-                if emoji in emoji_to_number:
-                    choices.append({
-                        "number": emoji_to_number[emoji],
-                        "text": text.strip()
-                    })
+            for line in description.split('\n'):
+                for emoji, number in _CHOICE_EMOJIS:
+                    if line.startswith(emoji):
+                        text = line[len(emoji):].strip()
+                        if text:
+                            choices.append(Choice(number, text))
+                        break
 
-            print(f"[DEBUG] parse_karuta_embed: Số lựa chọn hợp lệ: {len(choices)}")
+            log.debug("parse_karuta_embed: Số lựa chọn hợp lệ: %d", len(choices))
 
             # Kiểm tra dữ liệu tối thiểu
             if not character_name:
-                print("[DEBUG] parse_karuta_embed: THẤT BẠI - Không tìm thấy tên nhân vật")
+                log.debug("parse_karuta_embed: THẤT BẠI - Không tìm thấy tên nhân vật")
                 return None
                 
             if not question:
-                print("[DEBUG] parse_karuta_embed: THẤT BẠI - Không tìm thấy câu hỏi")
+                log.debug("parse_karuta_embed: THẤT BẠI - Không tìm thấy câu hỏi")
                 return None
                 
             if len(choices) < 2:
-                print(f"[DEBUG] parse_karuta_embed: THẤT BẠI - Chỉ có {len(choices)} lựa chọn (cần >=2)")
+                log.debug("parse_karuta_embed: THẤT BẠI - Chỉ có %d lựa chọn (cần >=2)", len(choices))
                 return None
 
-            print("[DEBUG] parse_karuta_embed: THÀNH CÔNG - Dữ liệu đầy đủ")
-            return {"character": character_name, "question": question, "choices": choices}
+            log.debug("parse_karuta_embed: THÀNH CÔNG - Dữ liệu đầy đủ")
+            return KVIPayload(character_name, question, choices)
 
         except Exception as e:
             print(f"❌ [PARSER] Lỗi: {e}")
             return None
 
-    async def analyze_with_ai(self, character: str, question: str, choices: List[Dict]) -> Optional[Dict]:
+    async def analyze_with_ai(self, character: str, question: str, choices: List[Choice]) -> Optional[Dict]:
         """Phân tích bằng Google Gemini"""
         if not self.api_key:
             return None
 
+        cache_key = _ai_cache_key(character, question, choices)
+        cached = _AI_CACHE.get(cache_key)
+        if cached:
+            if time.monotonic() < cached[0]:
+                _AI_CACHE.move_to_end(cache_key)
+                return cached[1]
+            del _AI_CACHE[cache_key]
+
         if not self.http_session or self.http_session.closed:
             await self.async_setup()
 
         url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={self.api_key}"
 
-        choices_text = "\n".join([f"{c['number']}. {c['text']}" for c in choices])
+        choices_text = "\n".join([f"{c.number}. {c.text}" for c in choices])
         prompt = (
             f"Phân tích tính cách '{character}' và trả lời câu hỏi: '{question}'\n"
             f"Lựa chọn:\n{choices_text}\n"
-            f'JSON: {{"analysis":"phân tích ngắn","percentages":[{{"choice":1,"percentage":50}}]}}'
+            f"analysis: phân tích ngắn; percentages: tỉ lệ cho từng lựa chọn"
         )
 
-        payload = {"contents": [{"parts": [{"text": prompt}]}]}
+        payload = {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": _GENERATION_CONFIG}
 
         try:
-            async with self.http_session.post(url, json=payload, timeout=8) as response:
+            async with self.http_session.post(
+                url, data=_json_dumps(payload), headers={"Content-Type": "application/json"}, timeout=_GEMINI_TIMEOUT
+            ) as response:
                 if response.status == 200:
-                    data = await response.json()
-                    result_text = data["candidates"][0]["content"]["parts"][0]["text"]
-                    result_text = result_text.strip().replace("```json", "").replace("```", "").strip()
-                    return json.loads(result_text)
+                    data = _json_loads(await response.read())
+                    result = _json_loads(data["candidates"][0]["content"]["parts"][0]["text"])
+                    _AI_CACHE[cache_key] = (time.monotonic() + _AI_CACHE_TTL, result)
+                    if len(_AI_CACHE) > _AI_CACHE_MAX:
+                        _AI_CACHE.popitem(last=False)
+                    return result
                 else:
                     error_text = await response.text()
                     print(f"❌ [AI] Lỗi API ({response.status}): {error_text}")
@@ -113,22 +213,25 @@ class KVIHelper:
             print(f"❌ [AI] Lỗi: {e}")
             return None
 
-    async def create_suggestion_embed(self, kvi_data: Dict, ai_result: Dict) -> discord.Embed:
+    async def create_suggestion_embed(self, kvi_data: KVIPayload, ai_result: Dict) -> discord.Embed:
         """Tạo embed gợi ý"""
         embed = discord.Embed(
             title="🎯 KVI Helper",
             color=0x00ff88,
-            description=f"**{kvi_data['character']}**\n*{kvi_data['question']}*"
+            description=f"**{kvi_data.character}**\n*{kvi_data.question}*"
         )
 
-        percentages = sorted(ai_result.get('percentages', []), key=lambda x: x.get('percentage', 0), reverse=True)
-
         # Mapping emoji theo số thứ tự
         emoji_map = {1: '1️⃣', 2: '2️⃣', 3: '3️⃣', 4: '4️⃣', 5: '5️⃣'}
-        available_choices = {c['number']: c['text'] for c in kvi_data['choices']}
+        available_choices = {c.number: c.text for c in kvi_data.choices}
+
+        # Chỉ cần tối đa 3 tỉ lệ cao nhất, không sắp xếp cả danh sách
+        percentages = heapq.nlargest(
+            min(3, len(available_choices)), ai_result.get('percentages', []), key=lambda x: x.get('percentage', 0)
+        )
 
         suggestions = []
-        for item in percentages[:min(3, len(available_choices))]:
+        for item in percentages:
             choice_num = item.get('choice')
             percentage = item.get('percentage')
             if choice_num is None or percentage is None or choice_num not in available_choices:
@@ -151,52 +254,55 @@ class KVIHelper:
         return embed
 
     async def handle_kvi_message(self, message):
-        print(f"\n[DEBUG] Step 1: Bot nhìn thấy tin nhắn từ '{message.author.name}'.")
+        """Điểm vào cho tin nhắn thô: lấy embed đầu tiên rồi chuyển cho handle_parsed"""
+        if not message.embeds:
+            return
+        embed = message.embeds[0]
+        await self.handle_parsed(message, embed, embed.description or "")
 
+    async def handle_parsed(self, message, embed, description: str):
+        """Xử lý tin nhắn có embed khi người gọi đã có sẵn embed và description"""
         # Chỉ xử lý tin nhắn từ Karuta
         if message.author.id != KARUTA_ID:
             return
+        log.debug("Step 1: Tin nhắn Karuta có %d embed", len(message.embeds))
 
-        # Kiểm tra có embed không - KHÔNG TẢI LẠI TIN NHẮN
-        if not message.embeds:
-            print("[DEBUG] Step 2: THẤT BẠI - Tin nhắn không có embed")
-            return
-        print(f"[DEBUG] Step 2: THÀNH CÔNG - Tin nhắn có {len(message.embeds)} embed")
-
-        embed = message.embeds[0]
-        description = embed.description or ""
-        
         # Kiểm tra điều kiện KVI đơn giản
         if "Your Affection Rating has" in description:
-            print("[DEBUG] Step 3: THẤT BẠI - Tin nhắn là Affection Rating, không phải KVI")
+            log.debug("Step 3: THẤT BẠI - Tin nhắn là Affection Rating, không phải KVI")
             return
             
         if "1️⃣" not in description:
-            print("[DEBUG] Step 3: THẤT BẠI - Không tìm thấy emoji lựa chọn")
+            log.debug("Step 3: THẤT BẠI - Không tìm thấy emoji lựa chọn")
+            return
+
+        # Dấu hiệu rẻ của embed nhân vật, loại sớm trước khi chạy regex
+        if "Character · **" not in description:
+            log.debug("Step 3: THẤT BẠI - Không phải embed nhân vật")
             return
             
-        print("[DEBUG] Step 3: THÀNH CÔNG - Đây là câu hỏi KVI hợp lệ")
+        log.debug("Step 3: THÀNH CÔNG - Đây là câu hỏi KVI hợp lệ")
 
         # Phân tích embed
-        kvi_data = self.parse_karuta_embed(embed)
+        kvi_data = self.parse_karuta_embed(embed, description)
         if not kvi_data:
-            print("[DEBUG] Step 4: THẤT BẠI - Phân tích embed thất bại")
+            log.debug("Step 4: THẤT BẠI - Phân tích embed thất bại")
             return
-        print(f"[DEBUG] Step 4: THÀNH CÔNG - Phân tích embed thành công - Character: {kvi_data['character']}")
+        log.debug("Step 4: THÀNH CÔNG - Phân tích embed thành công - Character: %s", kvi_data.character)
 
         # Gọi AI để phân tích
-        print("[DEBUG] Step 6: Gọi AI để phân tích...")
-        ai_result = await self.analyze_with_ai(kvi_data["character"], kvi_data["question"], kvi_data["choices"])
+        log.debug("Step 6: Gọi AI để phân tích...")
+        ai_result = await self.analyze_with_ai(kvi_data.character, kvi_data.question, kvi_data.choices)
         if not ai_result:
-            print("[DEBUG] Step 6: THẤT BẠI - AI phân tích thất bại")
+            log.debug("Step 6: THẤT BẠI - AI phân tích thất bại")
             return
 
         # Tạo embed gợi ý
-        print("[DEBUG] Step 7: Tạo embed gợi ý...")
+        log.debug("Step 7: Tạo embed gợi ý...")
         suggestion_embed = await self.create_suggestion_embed(kvi_data, ai_result)
 
         try:
             await message.channel.send(embed=suggestion_embed)
-            print("[DEBUG] Step 8: THÀNH CÔNG - Gửi gợi ý thành công!")
+            log.debug("Step 8: THÀNH CÔNG - Gửi gợi ý thành công!")
         except Exception as e:
-            print(f"❌ [DEBUG] Step 8: THẤT BẠI - Lỗi gửi tin nhắn: {e}")
+            print(f"❌ [KVI] Step 8: THẤT BẠI - Lỗi gửi tin nhắn: {e}")